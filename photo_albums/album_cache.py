@@ -0,0 +1,74 @@
+#coding: utf-8
+'''
+    Per-album version tokens for cache invalidation.
+
+    Each album has a version token stored in django cache. The token is
+    bumped when an image is saved or deleted (``post_save`` and
+    ``post_delete`` signals of ``AttachedImage`` are connected in
+    :mod:`photo_albums.models`, so changes made in admin or scripts are
+    caught too) and by views that update images without signals. Cache
+    keys that include the token become stale at once and there is no need
+    to find and delete them. Code that changes images with queryset
+    ``update()`` should call :func:`bump_album_version` itself.
+    The token is available in ``show_album.html`` and ``show_image.html``
+    templates as ``album_version`` variable and can be used with
+    ``{% cache %}`` template tag::
+
+        {% cache 600 album_images album.id album_version %}
+            ...
+        {% endcache %}
+
+    Token is the time of the last change (in microseconds since epoch).
+'''
+
+import time
+
+from django.core.cache import cache
+from django.contrib.contenttypes.models import ContentType
+from django.utils.hashcompat import md5_constructor
+
+VERSION_TIMEOUT = 60*60*24*30
+''' How long (in seconds) album version is kept in cache. '''
+
+
+def _version_key(obj):
+    content_type = ContentType.objects.get_for_model(obj)
+    return _album_version_key(content_type.pk, obj.pk)
+
+def _album_version_key(content_type_id, object_id):
+    return 'photo_albums.version.%d.%s' % (content_type_id, object_id)
+
+def _new_version():
+    return int(time.time() * 1000000)
+
+def get_album_version(obj):
+    ''' Returns version token of album attached to ``obj``. '''
+    version = cache.get(_version_key(obj))
+    if version is None:
+        version = bump_album_version(obj)
+    return version
+
+def bump_album_version(obj):
+    ''' Marks album attached to ``obj`` as changed. Returns new version token. '''
+    version = _new_version()
+    cache.set(_version_key(obj), version, VERSION_TIMEOUT)
+    return version
+
+def bump_image_album_version(sender, instance, **kwargs):
+    ''' ``post_save`` and ``post_delete`` receiver for ``AttachedImage``:
+        marks album of ``instance`` as changed. The album object is not
+        fetched.
+    '''
+    if instance.content_type_id is None or instance.object_id is None:
+        return
+    cache.set(_album_version_key(instance.content_type_id, instance.object_id),
+              _new_version(), VERSION_TIMEOUT)
+
+def page_cache_key(request, album_site, view_name, etag):
+    ''' Returns cache key for page rendered by view ``view_name``. ``etag``
+        of the page (it includes album version) makes the key change
+        whenever the page changes.
+    '''
+    url = md5_constructor(request.get_full_path()).hexdigest()
+    return 'photo_albums.page.%s.%s.%s.%s.%s' % (album_site.instance_name,
+                    view_name, etag, getattr(request, 'LANGUAGE_CODE', ''), url)
@@ -0,0 +1,223 @@
+#coding: utf-8
+'''
+    Load benchmark for ``PhotoAlbumSite`` views.
+
+    It creates a test database, generates synthetic album owners and albums
+    of given sizes (tiny generated images are shared by album rows), requests
+    each view of ``PhotoAlbumSite`` instance through django test client and
+    returns a report with response times, sql query counts and peak memory
+    usage of the process. Use ``album_benchmark`` management command to run
+    it and to save the report as json::
+
+        ./manage.py album_benchmark accounts.urls.accounts_photo_site --sizes=10,1000,100000
+
+    Url kwargs of album owner are built as ``{'object_id': owner.pk}`` by
+    default (see ``url_field`` parameter), so sites with ``object_getter``
+    should pass their own ``owner_kwargs`` function.
+
+    :func:`decrypt_benchmark` compares decryption speed of encrypted zip
+    members in bundled zipfile library::
+
+        ./manage.py album_benchmark --decrypt
+'''
+
+import os
+import resource
+import time
+from StringIO import StringIO
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.contrib.contenttypes.models import ContentType
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.db import connection, transaction
+from django.test.client import Client
+from django.test.utils import setup_test_environment, teardown_test_environment
+from django.utils import simplejson
+
+from generic_images.models import AttachedImage
+from photo_albums.test_utils import timing_stats, count_queries
+
+IMAGE_POOL_SIZE = 50
+''' Number of distinct image files shared by generated album rows. '''
+
+BENCHMARK_PASSWORD = 'album-benchmark'
+
+VIEWS = [
+    # view name, http method, whether view is for one image
+    ('show_album', 'get', False),
+    ('edit_album', 'get', False),
+    ('reorder_images', 'get', False),
+    ('album_api', 'get', False),
+    ('upload_main_image', 'get', False),
+    ('upload_images', 'get', False),
+    ('upload_zip', 'get', False),
+    ('set_image_order', 'post', False),
+    ('show_image', 'get', True),
+    ('edit_image', 'get', True),
+    ('image_api', 'get', True),
+    ('delete_image', 'get', True),
+    ('set_as_main_image', 'get', True),
+    ('clear_main_image', 'get', True),
+]
+
+
+def create_user_owner(index):
+    ''' Default owner factory: creates ``User``. '''
+    return User.objects.create_user('album_benchmark_%d' % index,
+                                    'album_benchmark_%d@example.com' % index,
+                                    BENCHMARK_PASSWORD)
+
+
+def generate_images(count, prefix='album_benchmark'):
+    ''' Saves ``count`` tiny jpeg images to default storage and
+        returns their names.
+    '''
+    from PIL import Image
+
+    names = []
+    for i in range(count):
+        buf = StringIO()
+        Image.new('RGB', (4, 4), (i*5 % 256, i*11 % 256, i*17 % 256)).save(buf, 'JPEG')
+        names.append(default_storage.save('%s/%d.jpg' % (prefix, i), ContentFile(buf.getvalue())))
+    return names
+
+
+@transaction.commit_on_success
+def populate_album(owner, size, user, image_names):
+    ''' Attaches ``size`` images to ``owner`` without sending signals. '''
+    content_type = ContentType.objects.get_for_model(owner)
+    images = []
+    for i in range(size):
+        image = AttachedImage(user=user, caption='image %d' % i, order=i+1,
+                              content_type=content_type, object_id=owner.pk,
+                              image=image_names[i % len(image_names)])
+        image.send_signal = False
+        images.append(image)
+
+    if hasattr(AttachedImage.objects, 'bulk_create'):
+        for start in range(0, len(images), 1000):
+            AttachedImage.objects.bulk_create(images[start:start+1000])
+    else:
+        for image in images:
+            image.save()
+
+
+def _request(client, method, url, data):
+    if method == 'post':
+        return client.post(url, data, HTTP_X_REQUESTED_WITH='XMLHttpRequest')
+    return client.get(url)
+
+
+def benchmark_album(album_site, owner, runs, url_kwargs):
+    ''' Requests every view of ``album_site`` for album of ``owner``
+        ``runs`` times and returns a list of per-view results.
+    '''
+    client = Client()
+    if isinstance(owner, User):
+        client.login(username=owner.username, password=BENCHMARK_PASSWORD)
+    else:
+        client.login(username='album_benchmark', password=BENCHMARK_PASSWORD)
+
+    album = AttachedImage.objects.for_model(owner)
+    image = album[0]
+    orders = list(album.values_list('id', 'order')[:100])
+    items = simplejson.dumps([{'id': str(pk), 'order': str(order)} for pk, order in orders])
+
+    results = []
+    for view, method, for_image in VIEWS:
+        kwargs = dict(url_kwargs)
+        if for_image:
+            kwargs['image_id'] = image.pk
+        url = album_site.reverse(view, kwargs=kwargs)
+
+        samples, queries, sql_times = [], [], []
+        for i in range(runs):
+            start = time.time()
+            count, sql_time, response = count_queries(_request, client, method, url,
+                                                      {'items': items})
+            samples.append(time.time() - start)
+            queries.append(count)
+            sql_times.append(sql_time)
+
+        stats = timing_stats(samples)
+        results.append({
+            'view': view,
+            'status': response.status_code,
+            'median_ms': stats['median'] * 1000,
+            'p95_ms': stats['p95'] * 1000,
+            'queries': max(queries),
+            'sql_ms': timing_stats(sql_times)['median'] * 1000,
+        })
+    return results
+
+
+def decrypt_benchmark(size=1024*1024, pwd='album-benchmark'):
+    ''' Decrypts ``size`` random bytes by calling zip decrypter for every
+        character (as it was done before) and by its table-driven
+        ``decrypt`` method. Returns report dict with speeds in MB/s.
+    '''
+    from photo_albums.lib.zipfile import _ZipDecrypter
+
+    data = os.urandom(size)
+    megabytes = float(size) / (1024*1024)
+
+    start = time.time()
+    ''.join(map(_ZipDecrypter(pwd), data))
+    per_char = time.time() - start
+
+    start = time.time()
+    _ZipDecrypter(pwd).decrypt(data)
+    table = time.time() - start
+
+    return {'size': size, 'per_char_mb_s': megabytes / per_char,
+            'table_mb_s': megabytes / table}
+
+
+def run_benchmark(album_site, sizes, runs=10, owner_factory=create_user_owner,
+                  owner_kwargs=None, url_field='pk'):
+    '''
+        Runs benchmark in a test database and returns report dict.
+
+        ``sizes`` is a list of album sizes, ``runs`` is how many times each
+        view is requested, ``owner_factory`` is a function that accepts
+        integer and returns new album owner object, ``owner_kwargs`` is a
+        function that accepts owner and returns url kwargs for it (default is
+        ``{'object_id': getattr(owner, url_field)}``).
+    '''
+    if owner_kwargs is None:
+        owner_kwargs = lambda owner: {'object_id': getattr(owner, url_field)}
+
+    setup_test_environment()
+    if hasattr(connection, 'settings_dict'):
+        old_name = connection.settings_dict['NAME']
+    else:
+        old_name = settings.DATABASE_NAME
+    connection.creation.create_test_db(verbosity=0, autoclobber=True)
+    image_names = []
+    try:
+        User.objects.create_superuser('album_benchmark', 'album_benchmark@example.com',
+                                      BENCHMARK_PASSWORD)
+        image_names = generate_images(min(IMAGE_POOL_SIZE, max(sizes)))
+
+        report = {'instance_name': album_site.instance_name, 'runs': runs, 'albums': []}
+        for index, size in enumerate(sizes):
+            owner = owner_factory(index)
+            user = owner if isinstance(owner, User) else None
+            start = time.time()
+            populate_album(owner, size, user, image_names)
+            populate_time = time.time() - start
+
+            report['albums'].append({
+                'size': size,
+                'populate_s': populate_time,
+                'views': benchmark_album(album_site, owner, runs, owner_kwargs(owner)),
+                'peak_memory_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+            })
+        return report
+    finally:
+        for name in image_names:
+            default_storage.delete(name)
+        connection.creation.destroy_test_db(old_name, verbosity=0)
+        teardown_test_environment()
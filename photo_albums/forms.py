@@ -3,8 +3,14 @@
 import tempfile
 import logging
 import os
+import threading
+import time
+import shutil
+import zlib
+from collections import deque
 
 from django import forms
+from django.db import transaction
 from django.db.models import Max
 from django.forms.models import modelformset_factory
 from django.utils.translation import ugettext_lazy as _
@@ -12,17 +18,18 @@ from django.core.files.uploadedfile import UploadedFile
 
 from generic_images.models import AttachedImage
 from generic_images.fields import force_recalculate
+from photo_albums.signals import zip_import_finished
 
 DIR_BIT = 16
 
-# Incremental approach for unzipping files in only supported in python >= 2.6.
-# Use backported zipfile.py library for python < 2.6
+STAGES = ('check', 'inflate', 'validate', 'store', 'insert', 'recalculate')
+''' Stages of zip import that are timed in ``UploadZipForm.stats``. '''
 
-try:
-    from zipfile import ZipFile, BadZipfile
-    from zipfile import ZipExtFile # <- this will fail on python < 2.6
-except ImportError:
-    from photo_albums.lib.zipfile import ZipFile, BadZipfile
+# Bundled zipfile.py library is used for all python versions: it supports
+# incremental unzipping for python < 2.6 and its ZipExtFile.readinto
+# decompresses straight into reusable buffer (python >= 2.6).
+from photo_albums.lib.zipfile import ZipFile, BadZipfile, ZIP_STORED, ZIP_DEFLATED
+from photo_albums.lib.zipfile import HAVE_BYTEARRAY
 
 
 class ImageEditForm(forms.ModelForm):
@@ -33,6 +40,10 @@ class ImageEditForm(forms.ModelForm):
 
 PhotoFormSet = modelformset_factory(AttachedImage, extra=3, fields = ['image', 'caption'])
 
+_ID_BATCH_SIZE = 500
+''' Number of values passed to one ``__in`` lookup (sqlite can't bind
+    more than 999 parameters). '''
+
 class _ExistingFile(UploadedFile):
     ''' Utility class for importing existing files to FileField's. '''
 
@@ -50,44 +61,396 @@ class _ExistingFile(UploadedFile):
         return 0
 
 
-def _file_path(uploaded_file):
+def _mkstemp(dir=None, prefix='tmp'):
+    ''' Creates temporary file in ``dir`` (system temp dir by default).
+        The directory is created if it doesn't exist.
+    '''
+    if dir is not None and not os.path.isdir(dir):
+        try:
+            os.makedirs(dir)
+        except OSError:
+            # could be created by another thread
+            if not os.path.isdir(dir):
+                raise
+    return tempfile.mkstemp(prefix=prefix, dir=dir)
+
+
+def _file_path(uploaded_file, dir=None):
     '''  Converts InMemoryUploadedFile to on-disk file so it will have path. '''
     try:
         return uploaded_file.temporary_file_path()
     except AttributeError:
-        fileno, path = tempfile.mkstemp()
+        fileno, path = _mkstemp(dir)
         temp_file = os.fdopen(fileno,'w+b')
-        for chunk in uploaded_file.chunks():
-            temp_file.write(chunk)
+        try:
+            for chunk in uploaded_file.chunks():
+                temp_file.write(chunk)
+        except:
+            temp_file.close()
+            os.unlink(path)
+            raise
         temp_file.close()
         return path
 
 
+def _zip_source(uploaded_file, max_memory_size, dir=None):
+    ''' Returns seekable in-memory buffer of InMemoryUploadedFile if it is
+        not bigger than ``max_memory_size`` and path to on-disk file otherwise.
+    '''
+    if hasattr(uploaded_file, 'temporary_file_path') or uploaded_file.size > max_memory_size:
+        return _file_path(uploaded_file, dir)
+    uploaded_file.file.seek(0)
+    return uploaded_file.file
+
+
+def _source_size(source):
+    if isinstance(source, basestring):
+        return os.path.getsize(source)
+    source.seek(0, 2)
+    return source.tell()
+
+
+def _remove_file(source):
+    ''' Removes zip file if ``source`` is a path. '''
+    if isinstance(source, basestring):
+        try:
+            os.unlink(source)
+        except OSError:
+            pass
+
+
+class _CorruptMember(Exception):
+    ''' Raised if archive member can't be extracted or has wrong CRC. '''
+    def __init__(self, name):
+        self.name = name
+        super(_CorruptMember, self).__init__(name)
+
+
+def _extract_member(zf, info, chunksize, dir=None):
+    ''' Extracts archive member to temporary file and returns its path.
+        CRC of extracted data is checked on the fly and _CorruptMember is
+        raised on mismatch. Stored members of lazily opened archive files
+        are copied straight from memory-mapped archive.
+    '''
+    fileno, path = _mkstemp(dir)
+    outfile = os.fdopen(fileno,'w+b')
+    try:
+        try:
+            if not zf.copystored(info, outfile):
+                stream = zf.open(info)
+                if HAVE_BYTEARRAY:
+                    data = bytearray(chunksize)
+                    while True:
+                        size = stream.readinto(data)
+                        if not size:
+                            break
+                        outfile.write(buffer(data, 0, size))
+                else:
+                    while True:
+                        hunk = stream.read(chunksize)
+                        if not hunk:
+                            break
+                        outfile.write(hunk)
+        except (BadZipfile, zlib.error, RuntimeError):
+            # RuntimeError is raised for member with another password
+            raise _CorruptMember(info.filename)
+    except:
+        outfile.close()
+        os.unlink(path)
+        raise
+    outfile.close()
+    return path
+
+
 class UploadZipForm(forms.Form):
     '''
         A base form class for uploading several files packed as one .zip file.
         Extract files and provides hook for processing extracted files.
         During extraction it loads uncompressed files to memory by chunks so it
         is safe to process zip archives with big files inside.
+
+        Files can be extracted and prechecked by a pool of worker threads
+        (see ``extract_workers``) while ``process_file`` is still called
+        from the current thread in archive order.
+
+        Encrypted archives are supported: value of ``password`` field is
+        used as password for all encrypted members.
+
+        Import statistics are collected in ``stats`` dict: time (in seconds)
+        spent in each of :data:`STAGES` (``'check'`` is archive validation,
+        ``'inflate'`` is extraction, ``'validate'`` is ``precheck_file``,
+        other stages are filled by subclasses) and in whole
+        ``process_zip_file`` (``'total'``), compressed and uncompressed size
+        of extracted members (``'bytes_in'`` and ``'bytes_out'``), number of
+        ``'accepted'`` and ``'rejected'`` members (counted by subclasses)
+        and the peak size of extracted files waiting for processing
+        (``'peak_temp_bytes'``). Stage times of parallel workers are summed.
+        ``zip_import_finished`` signal is sent with ``stats`` after
+        successful processing.
     '''
 
     zip_file = forms.FileField()
+    password = forms.CharField(label=_('password'), required=False,
+                               widget=forms.PasswordInput(render_value=False),
+                               help_text=_('Fill this in if the .zip archive is encrypted.'))
+
+    extract_workers = 0
+    ''' Number of worker threads used for extracting and prechecking files.
+        0 means that files are extracted one by one in the current thread.
+    '''
+
+    max_in_flight = None
+    ''' Maximum number of extracted files waiting for ``process_file``
+        (and so the maximum number of temporary files on disk). Default is
+        twice the ``extract_workers`` value.
+    '''
+
+    single_pass = False
+    ''' If True, only the central directory is checked during validation and
+        CRCs are checked while files are extracted, so every member is
+        decompressed only once. If corrupt member is found during processing
+        then ``rollback`` is called and ``forms.ValidationError`` is raised
+        by ``process_zip_file``.
+    '''
+
+    in_memory_max_size = 2621440
+    ''' In-memory uploaded files not bigger than this size (2.5 MB by
+        default) are read straight from memory instead of being written
+        to temporary file first.
+    '''
+
+    progress_callback = None
+    ''' Optional callable that is called with ``file_num`` and ``files_count``
+        after each processed file.
+    '''
+
+    scratch_dir = None
+    ''' Directory for temporary files (extracted members and uploaded
+        archive). Default is system temp dir. Set it to a directory on the
+        same filesystem as ``MEDIA_ROOT`` so extracted files are moved to
+        storage by atomic rename instead of being copied (django's
+        ``file_move_safe`` copies only if rename fails). Temporary files
+        are created with 0600 permissions and keep them after rename, so
+        ``FILE_UPLOAD_PERMISSIONS`` setting should be set too.
+    '''
+
+    unpack_patterns = None
+    ''' Optional list of shell-style patterns (e.g. ``['*.jpg']``, case is
+        ignored). Archive members with other names are skipped before
+        their ``ZipInfo`` objects are created and ``needs_unpacking`` is
+        called, this is much faster for archives with many entries.
+        Skipped members are not checked for corruption either. Patterns
+        must match all names accepted by ``needs_unpacking``: if it is
+        overridden to accept other files, extend or unset the patterns.
+    '''
+
+    def __init__(self, *args, **kwargs):
+        super(UploadZipForm, self).__init__(*args, **kwargs)
+        self.precheck_results = {}
+        self.zip_path = None
+        self._stats_lock = threading.Lock()
+        self.stats = dict([(stage, 0.0) for stage in STAGES])
+        self.stats.update(total=0.0, bytes_in=0, bytes_out=0, accepted=0,
+                          rejected=0, temp_bytes=0, peak_temp_bytes=0)
+
+    def add_stats(self, **values):
+        ''' Adds ``values`` to ``stats`` counters. Can be called from
+            worker threads.
+        '''
+        self._stats_lock.acquire()
+        try:
+            for key, value in values.items():
+                self.stats[key] = self.stats.get(key, 0) + value
+            if self.stats['temp_bytes'] > self.stats['peak_temp_bytes']:
+                self.stats['peak_temp_bytes'] = self.stats['temp_bytes']
+        finally:
+            self._stats_lock.release()
+
+    def set_zip_path(self, path):
+        ''' Makes the form use archive that is already stored at ``path``
+            (e.g. assembled from chunks) instead of uploaded file, so
+            ``zip_file`` field is not required. The archive is checked
+            during validation and removed by ``process_zip_file``.
+        '''
+        self.zip_path = path
+        self.fields['zip_file'].required = False
+
 
     def clean_zip_file(self):
-        ''' Checks if zip file is not corrupted, stores in-memory uploaded file
-            to disk and returns path to stored file.
+        ''' Checks if zip file is not corrupted. Returns in-memory buffer for
+            small in-memory uploaded files (see ``in_memory_max_size``),
+            stores bigger ones to disk and returns path to stored file.
         '''
-        path = _file_path(self.cleaned_data['zip_file'])
+        if self.zip_path is not None:
+            self.check_zip_file(self.zip_path)
+            return self.zip_path
+
+        uploaded_file = self.cleaned_data['zip_file']
+        source = _zip_source(uploaded_file, self.in_memory_max_size, self.scratch_dir)
         try:
-            zf = ZipFile(path)
-            bad_file = zf.testzip()
-            if bad_file:
-                raise forms.ValidationError(_('"%s" in the .zip archive is corrupt.') % bad_file)
-            zf.close()
-        except BadZipfile:
-            raise forms.ValidationError(_('Uploaded file is not a zip file.'))
+            self.check_zip_file(source)
+        except:
+            # remove temporary file if it was created by _zip_source
+            if not hasattr(uploaded_file, 'temporary_file_path'):
+                _remove_file(source)
+            raise
+        return source
 
-        return path
+
+    def detach_zip_file(self):
+        ''' Makes the validated zip file independent from current request
+            (e.g. for processing in background): temporary files of
+            uploaded files are moved and in-memory buffers are copied to
+            temporary file owned by the form. Temporary file is copied too
+            if it can't be moved (e.g. ``scratch_dir`` is on other device).
+        '''
+        source = self.cleaned_data['zip_file']
+        uploaded_file = self.files.get(self.add_prefix('zip_file'))
+        if isinstance(source, basestring):
+            try:
+                if source != uploaded_file.temporary_file_path():
+                    return
+            except AttributeError:
+                return
+
+        fileno, path = _mkstemp(self.scratch_dir)
+        if isinstance(source, basestring):
+            try:
+                # django ignores missing temporary file when it is closed
+                os.rename(source, path)
+                os.close(fileno)
+                self.cleaned_data['zip_file'] = path
+                return
+            except OSError:
+                source = open(source, 'rb')
+
+        temp_file = os.fdopen(fileno,'w+b')
+        try:
+            source.seek(0)
+            shutil.copyfileobj(source, temp_file)
+        except:
+            temp_file.close()
+            os.unlink(path)
+            raise
+        temp_file.close()
+        if source is not uploaded_file.file:
+            source.close()
+        self.cleaned_data['zip_file'] = path
+
+
+    def get_password(self):
+        ''' Returns the password entered for encrypted archive (as utf-8
+            encoded string) or None. It can be called before ``password``
+            field is cleaned.
+        '''
+        if 'password' in self.cleaned_data:
+            password = self.cleaned_data['password']
+        else:
+            field = self.fields['password']
+            password = field.widget.value_from_datadict(self.data, self.files,
+                                                        self.add_prefix('password'))
+        if not password:
+            return None
+        if isinstance(password, unicode):
+            # zip encryption works with bytes
+            password = password.encode('utf-8')
+        return password
+
+
+    def open_zip_file(self, source):
+        ''' Returns ZipFile for path or file-like object ``source`` with
+            the entered password set. Central directory of the archive is
+            available as ``ZipIndex`` in ``index`` attribute.
+        '''
+        zf = ZipFile(source, lazy=True)
+        zf.setpassword(self.get_password())
+        return zf
+
+
+    def unpack_indexes(self, zf):
+        ''' Returns indexes of ``zf.index`` entries with names matching
+            ``unpack_patterns``.
+        '''
+        if self.unpack_patterns:
+            return zf.index.filter(self.unpack_patterns)
+        return xrange(len(zf.index))
+
+
+    def check_password(self, zf, indexes):
+        ''' Raises RuntimeError if some of entries with ``indexes`` are
+            encrypted and the password is missing or wrong. Only the
+            password check byte of the first encrypted entry is tested.
+        '''
+        flags = zf.index.flags
+        for i in indexes:
+            if flags[i] & 0x1:
+                zf.open(zf.index.info(i)).close()
+                return
+
+
+    def test_members(self, zf, indexes):
+        ''' Reads entries with ``indexes`` and checks their CRC. Returns the
+            name of the first corrupt entry and None if there is no such entry.
+        '''
+        for i in indexes:
+            info = zf.index.info(i)
+            try:
+                stream = zf.open(info)
+                if HAVE_BYTEARRAY:
+                    data = bytearray(1024*1024)
+                    while stream.readinto(data):
+                        pass
+                else:
+                    while stream.read(1024*1024):
+                        pass
+            except (BadZipfile, zlib.error):
+                return info.filename
+        return None
+
+
+    def check_zip_file(self, source):
+        ''' Raises ``forms.ValidationError`` if zip file (path or file-like
+            object) is corrupted.
+        '''
+        start = time.time()
+        try:
+            try:
+                zf = self.open_zip_file(source)
+                try:
+                    indexes = self.unpack_indexes(zf)
+                    self.check_password(zf, indexes)
+                    if self.single_pass:
+                        bad_file = self.check_central_directory(zf, _source_size(source),
+                                                                indexes)
+                    else:
+                        bad_file = self.test_members(zf, indexes)
+                finally:
+                    zf.close()
+            except BadZipfile:
+                raise forms.ValidationError(_('Uploaded file is not a zip file.'))
+            except RuntimeError:
+                if self.get_password() is None:
+                    raise forms.ValidationError(_('The .zip archive is encrypted, please enter the password.'))
+                raise forms.ValidationError(_('Wrong password for the .zip archive.'))
+        finally:
+            self.add_stats(check=time.time()-start)
+        if bad_file:
+            raise forms.ValidationError(_('"%s" in the .zip archive is corrupt.') % bad_file)
+
+
+    def check_central_directory(self, zf, size, indexes):
+        ''' Cheap check of entries with ``indexes`` that doesn't decompress
+            anything. Returns the name of the first entry with unsupported
+            compression method or with data outside of ``size`` bytes
+            long file and None if there is no such entry.
+        '''
+        for i in indexes:
+            compress_type, compress_size, header_offset = zf.index.layout(i)
+            if compress_type not in (ZIP_STORED, ZIP_DEFLATED):
+                return zf.index.name(i)
+            if header_offset + compress_size > size:
+                return zf.index.name(i)
+        return None
 
 
     def needs_unpacking(self, name, info):
@@ -123,49 +486,155 @@ class UploadZipForm(forms.Form):
         '''
         raise NotImplementedError
 
-    def process_zip_file(self, chunksize=1024*64):
+    def rollback(self):
+        '''
+        Override this in subclass to undo the work done by ``process_file``.
+        It is called if corrupt member is found during processing.
+        '''
+        pass
+
+    def precheck_file(self, path, name, info):
+        '''
+        Override this in subclass to do CPU-heavy checks of extracted file.
+        It is called right after extraction, in a worker thread if
+        ``extract_workers`` is set, so it must not touch the database.
+        The result is stored in ``self.precheck_results[path]`` before
+        ``process_file`` is called.
+        '''
+        return None
+
+    def process_zip_file(self, chunksize=1024*64, workers=None):
         '''
             Extract all files to temporary place and call process_file method
             for each.
 
-            ``chunksize`` is the size of block in which compressed files are
-            read. Default is 64k. Do not set it below 64k because data from
-            compressed files will be read in blocks >= 64k anyway.
+            ``chunksize`` is the size of buffer files are extracted to.
+            Default is 64k. Compressed data is read in blocks that start
+            at 64k and grow up to 1M, so small ``chunksize`` only means
+            more write calls.
+
+            ``workers`` overrides ``extract_workers`` attribute.
         '''
+        start = time.time()
 
-        zip_filename = self.cleaned_data['zip_file'] #should contain zip file path
+        # should contain zip file path or in-memory buffer
+        zip_source = self.cleaned_data['zip_file']
 
-        zf = ZipFile(zip_filename)
+        if workers is None:
+            workers = self.extract_workers
 
-        names = zf.namelist()
-        infos = zf.infolist()
+        # worker threads can't share one in-memory buffer; in-memory
+        # archives are small anyway
+        if not isinstance(zip_source, basestring):
+            workers = 0
 
-        files_to_unpack = []
+        zf = self.open_zip_file(zip_source)
+        try:
+            files_to_unpack = []
+
+            for info in zf.index.infolist(self.unpack_indexes(zf)):
+                if self.needs_unpacking(info.filename, info):
+                    files_to_unpack.append((info.filename, info))
+
+            if workers:
+                extracted = self._extract_parallel(zip_source, files_to_unpack,
+                                                   chunksize, workers)
+            else:
+                extracted = self._extract_serial(zf, files_to_unpack, chunksize)
+
+            try:
+                try:
+                    for counter, (name, info, path, result) in enumerate(extracted):
+                        self.precheck_results[path] = result
+
+                        # do something with extracted file
+                        self.process_file(path, name, info, counter, len(files_to_unpack))
+                        self.add_stats(temp_bytes=-info.file_size)
+
+                        if self.progress_callback is not None:
+                            self.progress_callback(counter, len(files_to_unpack))
+                finally:
+                    extracted.close()
+            except _CorruptMember, e:
+                self.rollback()
+                raise forms.ValidationError(_('"%s" in the .zip archive is corrupt.') % e.name)
+        finally:
+            zf.close()
+            _remove_file(zip_source)
+            self.add_stats(total=time.time()-start)
 
-        for name, info in zip(names, infos):
-            if self.needs_unpacking(name, info):
-                files_to_unpack.append((name, info))
+        zip_import_finished.send(sender=self.__class__, form=self, stats=self.stats)
 
-        for counter, (name, info,) in enumerate(files_to_unpack):
+    def _extract(self, zf, name, info, chunksize):
+        ''' Extracts and prechecks one member, returns its path and
+            precheck result.
+        '''
+        start = time.time()
+        path = _extract_member(zf, info, chunksize, self.scratch_dir)
+        extracted = time.time()
+        self.add_stats(inflate=extracted-start, bytes_in=info.compress_size,
+                       bytes_out=info.file_size, temp_bytes=info.file_size)
+        try:
+            result = self.precheck_file(path, name, info)
+        except:
+            os.unlink(path)
+            self.add_stats(temp_bytes=-info.file_size)
+            raise
+        self.add_stats(validate=time.time()-extracted)
+        return path, result
 
+    def _extract_serial(self, zf, files, chunksize):
+        for name, info in files:
             # extract file to temporary place
-            fileno, path = tempfile.mkstemp()
-            outfile = os.fdopen(fileno,'w+b')
+            path, result = self._extract(zf, name, info, chunksize)
+            yield name, info, path, result
+
+    def _extract_parallel(self, zip_filename, files, chunksize, workers):
+        ''' Extracts and prechecks files in thread pool and yields them in
+            archive order. Each worker thread reads the archive through its
+            own ZipFile instance.
+        '''
+        from multiprocessing.pool import ThreadPool
 
-            stream = zf.open(info)
-            while True:
-                hunk = stream.read(chunksize)
-                if not hunk:
-                    break
-                outfile.write(hunk)
+        local = threading.local()
+        opened = []
 
-            outfile.close()
+        def extract(name, info):
+            zf = getattr(local, 'zf', None)
+            if zf is None:
+                zf = local.zf = self.open_zip_file(zip_filename)
+                opened.append(zf)
+            return self._extract(zf, name, info, chunksize)
 
-            # do something with extracted file
-            self.process_file(path, name, info, counter, len(files_to_unpack))
+        max_in_flight = max(self.max_in_flight or workers*2, 1)
+        pool = ThreadPool(workers)
+        pending = deque()
 
-        zf.close()
-        os.unlink(zip_filename)
+        def finished():
+            name, info, result = pending.popleft()
+            path, precheck = result.get()
+            return name, info, path, precheck
+
+        try:
+            for name, info in files:
+                pending.append((name, info, pool.apply_async(extract, (name, info))))
+                if len(pending) >= max_in_flight:
+                    yield finished()
+            while pending:
+                yield finished()
+        finally:
+            # processing was interrupted: remove files that were not processed
+            while pending:
+                try:
+                    name, info, path, precheck = finished()
+                    os.unlink(path)
+                    self.add_stats(temp_bytes=-info.file_size)
+                except Exception:
+                    pass
+            pool.close()
+            pool.join()
+            for zf in opened:
+                zf.close()
 
 
 class UploadZipAlbumForm(UploadZipForm):
@@ -173,12 +642,38 @@ class UploadZipAlbumForm(UploadZipForm):
         Only valid images are stored. Uploaded images are marked as uploaded
         by ``user`` and are attached to ``obj`` model.
     '''
+
+    image_validation = 'full'
+    ''' ``'full'``: image is checked by PIL's ``verify`` which reads the whole
+        file. ``'header'``: only file signature (see ``image_signatures``) and
+        image header are checked, this is much faster for big images.
+    '''
+
+    image_signatures = ('\xff\xd8\xff', '\x89PNG\r\n\x1a\n', 'GIF87a', 'GIF89a')
+    ''' Allowed file signatures for ``'header'`` image validation. '''
+
+    max_image_pixels = None
+    ''' Images with more pixels (width*height) are rejected. Use it to
+        protect against decompression bombs.
+    '''
+
+    max_image_size = None
+    ''' Files bigger than this size (in bytes) are rejected. '''
+
+    batch_size = None
+    ''' If set, image files are moved to storage as they are extracted
+        but database rows are inserted in batches of this size, each batch
+        in one transaction (with one query if ``bulk_create`` is supported).
+    '''
+
     def __init__(self, user, obj, *args, **kwargs):
         super(UploadZipAlbumForm, self).__init__(*args, **kwargs)
 
         self.user = user
         self.obj = obj
         self.order = AttachedImage.objects.for_model(obj).aggregate(max_order=Max('order'))['max_order']
+        self.created_images = []
+        self.pending_images = []
 
         self.fields['zip_file'].label = _('images file (.zip)')
         self.fields['zip_file'].help_text = _('Select a .zip file of images to upload.')
@@ -190,6 +685,9 @@ class UploadZipAlbumForm(UploadZipForm):
             False otherwise. Override in subclass to customize behaviour.
             Default is to skip directories, meta files
             (names starts with ``'__'``) and files with non-image extensions.
+            Set ``unpack_patterns`` to ``['*.jpg', '*.jpeg', '*.png',
+            '*.gif']`` to skip other files faster (but keep it in sync
+            with this method).
         '''
         for ext in ['.jpg', '.jpeg', '.png', '.gif']:
             if name.lower().endswith(ext):
@@ -198,12 +696,33 @@ class UploadZipAlbumForm(UploadZipForm):
 
 
     def is_valid_image(self, path):
-        ''' Check if file is readable by PIL. '''
+        ''' Check if file is readable by PIL. Files bigger than
+            ``max_image_size`` and images with more than ``max_image_pixels``
+            pixels are rejected before image data is decoded. Image data is
+            decoded only if ``image_validation`` is ``'full'``.
+        '''
+        if self.max_image_size is not None and os.path.getsize(path) > self.max_image_size:
+            return False
+
+        if self.image_validation == 'header':
+            image_file = open(path, 'rb')
+            try:
+                head = image_file.read(16)
+            finally:
+                image_file.close()
+            if not [sig for sig in self.image_signatures if head.startswith(sig)]:
+                return False
+
         from PIL import Image
 
         try:
-            trial_image = Image.open(path)
-            trial_image.verify()
+            trial_image = Image.open(path) # reads only image header
+            if self.max_image_pixels is not None:
+                width, height = trial_image.size
+                if width * height > self.max_image_pixels:
+                    return False
+            if self.image_validation == 'full':
+                trial_image.verify()
         except ImportError:
             # Under PyPy, it is possible to import PIL. However, the underlying
             # _imaging C module isn't available, so an ImportError will be
@@ -215,6 +734,11 @@ class UploadZipAlbumForm(UploadZipForm):
         return True
 
 
+    def precheck_file(self, path, name, info):
+        ''' Check if file is a valid image (possibly in a worker thread). '''
+        return self.is_valid_image(path)
+
+
     def process_file(self, path, name, info, file_num, files_count):
         ''' Create AttachedImage instance if file is a valid image. '''
 
@@ -222,7 +746,12 @@ class UploadZipAlbumForm(UploadZipForm):
         fname = os.path.split(name)[1]
 
         # only process valid images
-        if self.is_valid_image(path):
+        is_valid = self.precheck_results.pop(path, None)
+        if is_valid is None:
+            is_valid = self.is_valid_image(path)
+
+        if is_valid:
+            self.add_stats(accepted=1)
             self.order += 1
             image = AttachedImage(user = self.user, caption = '',
                                   order = self.order, content_object = self.obj)
@@ -233,8 +762,20 @@ class UploadZipAlbumForm(UploadZipForm):
 
             # Move file to proper place (without copying if it is possible) and
             # create record in database
-            image.image.save(image.get_upload_path(fname), _ExistingFile(path))
+            start = time.time()
+            image.image.save(image.get_upload_path(fname), _ExistingFile(path), save=False)
+            self.add_stats(store=time.time()-start)
+            if self.batch_size:
+                self.pending_images.append(image)
+                if len(self.pending_images) >= self.batch_size:
+                    self.save_pending_images()
+            else:
+                start = time.time()
+                image.save()
+                self.add_stats(insert=time.time()-start)
+            self.created_images.append(image)
         else:
+            self.add_stats(rejected=1)
             # image is invalid, we should delete temp file
             os.unlink(path)
 
@@ -242,4 +783,45 @@ class UploadZipAlbumForm(UploadZipForm):
         # recalculate denormalised values
         is_last = (file_num == (files_count-1))
         if is_last:
+            self.save_pending_images()
+            start = time.time()
             force_recalculate(self.obj)
+            self.add_stats(recalculate=time.time()-start)
+
+
+    @transaction.commit_on_success
+    def save_pending_images(self):
+        ''' Insert rows for images that are already in storage
+            (see ``batch_size``).
+        '''
+        if not self.pending_images:
+            return
+        start = time.time()
+        if hasattr(AttachedImage.objects, 'bulk_create'):
+            AttachedImage.objects.bulk_create(self.pending_images)
+        else:
+            for image in self.pending_images:
+                image.save()
+        self.pending_images = []
+        self.add_stats(insert=time.time()-start)
+
+
+    def rollback(self):
+        ''' Delete images created during processing. Database rows are
+            deleted first so that no rows are left pointing to deleted
+            files if it fails.
+        '''
+        self._delete_created_rows()
+        for image in self.created_images:
+            image.image.delete(save=False)
+        self.created_images = []
+        self.pending_images = []
+
+    @transaction.commit_on_success
+    def _delete_created_rows(self):
+        # images inserted with bulk_create have no pk so rows are found by
+        # file names
+        names = [image.image.name for image in self.created_images]
+        album = AttachedImage.objects.for_model(self.obj)
+        for start in range(0, len(names), _ID_BATCH_SIZE):
+            album.filter(image__in=names[start:start+_ID_BATCH_SIZE]).delete()
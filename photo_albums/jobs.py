@@ -0,0 +1,105 @@
+#coding: utf-8
+'''
+    Background zip imports.
+
+    When ``zip_import_async`` is enabled for ``PhotoAlbumSite``,
+    :func:`~photo_albums.views.upload_zip` view validates the uploaded archive,
+    queues it to a worker thread and returns job id at once. Job state
+    (``'queued'``, ``'running'``, ``'done'`` or ``'failed'``) and progress are
+    stored in django cache and are available from
+    :func:`~photo_albums.views.upload_zip_progress` view.
+
+    Worker thread lives in the web server process, so archives queued
+    to a process are lost if this process is restarted. Cache backend
+    must be shared between processes (memcached, database, etc.) if there
+    are several web server processes.
+'''
+
+import logging
+import threading
+import uuid
+import Queue
+
+from django.core.cache import cache
+from django.db import connection
+from django.forms import ValidationError
+
+JOB_TIMEOUT = 60*60*24
+''' How long (in seconds) job state is kept in cache. '''
+
+_queue = Queue.Queue()
+_worker = None
+_worker_lock = threading.Lock()
+
+
+def _cache_key(job_id):
+    return 'photo_albums.zip_job.%s' % job_id
+
+def get_job(job_id):
+    ''' Returns job state dict or None if job is unknown. '''
+    return cache.get(_cache_key(job_id))
+
+def _update_job(job_id, **kwargs):
+    job = get_job(job_id) or {}
+    job.update(kwargs)
+    cache.set(_cache_key(job_id), job, JOB_TIMEOUT)
+
+
+def _run(job_id, form, on_success):
+    def progress(file_num, files_count):
+        _update_job(job_id, state='running', file_num=file_num+1,
+                    files_count=files_count)
+    form.progress_callback = progress
+
+    _update_job(job_id, state='running')
+    try:
+        form.process_zip_file()
+    except ValidationError, e:
+        _update_job(job_id, state='failed', errors=[unicode(m) for m in e.messages])
+    except Exception:
+        logging.exception('Zip import job %s failed' % job_id)
+        _update_job(job_id, state='failed', errors=[])
+    else:
+        _update_job(job_id, state='done')
+        if on_success is not None:
+            on_success()
+
+
+def _work():
+    while True:
+        job_id, form, on_success = _queue.get()
+        try:
+            _run(job_id, form, on_success)
+        finally:
+            # each thread has its own database connection
+            connection.close()
+
+
+def _ensure_worker():
+    global _worker
+    _worker_lock.acquire()
+    try:
+        if _worker is None or not _worker.isAlive():
+            _worker = threading.Thread(target=_work, name='photo_albums zip import')
+            _worker.setDaemon(True)
+            _worker.start()
+    finally:
+        _worker_lock.release()
+
+
+def start_zip_import(form, owner, on_success=None):
+    '''
+        Queues ``process_zip_file`` call for valid ``form`` and returns job id.
+        ``owner`` is any picklable value stored with the job (views use it to
+        check that job belongs to the album). ``on_success`` is an optional
+        callable that is called in worker thread after successful import.
+    '''
+    form.detach_zip_file()
+
+    job_id = uuid.uuid4().hex
+    _update_job(job_id, owner=owner, state='queued', file_num=0,
+                files_count=None, errors=[])
+
+    _ensure_worker()
+    _queue.put((job_id, form, on_success))
+    return job_id
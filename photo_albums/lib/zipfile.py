@@ -3,6 +3,19 @@ Read and write ZIP files.
 """
 import struct, os, time, sys, shutil
 import binascii, cStringIO, stat
+import array, fnmatch, re
+
+try:
+    import mmap
+except ImportError:
+    mmap = None
+
+try:
+    bytearray
+    HAVE_BYTEARRAY = True
+except NameError:
+    # python < 2.6: use read() instead of readinto()
+    HAVE_BYTEARRAY = False
 
 try:
     import zlib # We may need its compression method
@@ -12,7 +25,7 @@ except ImportError:
     crc32 = binascii.crc32
 
 __all__ = ["BadZipfile", "error", "ZIP_STORED", "ZIP_DEFLATED", "is_zipfile",
-           "ZipInfo", "ZipFile", "PyZipFile", "LargeZipFile" ]
+           "ZipInfo", "ZipIndex", "ZipFile", "PyZipFile", "LargeZipFile" ]
 
 class BadZipfile(Exception):
     pass
@@ -387,7 +400,7 @@ class _ZipDecrypter:
     Usage:
         zd = _ZipDecrypter(mypwd)
         plain_char = zd(cypher_char)
-        plain_text = map(zd, cypher_text)
+        plain_text = zd.decrypt(cypher_text)
     """
 
     def _GenerateCRCTable():
@@ -410,6 +423,20 @@ class _ZipDecrypter:
         return table
     crctable = _GenerateCRCTable()
 
+    def _GenerateStreamTable():
+        """Generate a table of key stream bytes.
+
+        Key stream byte is ((k * (k ^ 1)) >> 8) & 255 where k = key2 | 2.
+        It only depends on the low 16 bits of key2, so it is looked up by
+        key2 & 0xffff instead of being computed for every byte.
+        """
+        table = [0] * 0x10000
+        for i in range(0x10000):
+            k = i | 2
+            table[i] = ((k * (k ^ 1)) >> 8) & 255
+        return table
+    streamtable = _GenerateStreamTable()
+
     def _crc32(self, ch, crc):
         """Compute the CRC32 primitive on one byte."""
         return ((crc >> 8) & 0xffffff) ^ self.crctable[(crc ^ ord(ch)) & 0xff]
@@ -436,6 +463,167 @@ class _ZipDecrypter:
         self._UpdateKeys(c)
         return c
 
+    def decrypt(self, data):
+        """Decrypt a string. Much faster than calling the decrypter
+        for every character: keys are kept in local variables and key
+        stream bytes are taken from streamtable."""
+        crctable = self.crctable
+        streamtable = self.streamtable
+        key0, key1, key2 = self.key0, self.key1, self.key2
+        result = []
+        append = result.append
+        if HAVE_BYTEARRAY:
+            data = bytearray(data)
+        else:
+            data = map(ord, data)
+        for c in data:
+            c ^= streamtable[key2 & 0xffff]
+            append(c)
+            key0 = (key0 >> 8) ^ crctable[(key0 ^ c) & 0xff]
+            key1 = ((key1 + (key0 & 0xff)) * 134775813 + 1) & 0xffffffff
+            key2 = (key2 >> 8) ^ crctable[(key2 ^ (key1 >> 24)) & 0xff]
+        self.key0, self.key1, self.key2 = key0, key1, key2
+        if HAVE_BYTEARRAY:
+            return str(bytearray(result))
+        return ''.join(map(chr, result))
+
+def _InfoFromCentralDir(centdir, filename, extra, comment, concat):
+    """Create ZipInfo instance from unpacked central directory record."""
+    x = ZipInfo(filename)
+    x.extra = extra
+    x.comment = comment
+    x.header_offset = centdir[_CD_LOCAL_HEADER_OFFSET]
+    (x.create_version, x.create_system, x.extract_version, x.reserved,
+        x.flag_bits, x.compress_type, t, d,
+        x.CRC, x.compress_size, x.file_size) = centdir[1:12]
+    x.volume, x.internal_attr, x.external_attr = centdir[15:18]
+    # Convert date/time code to (year, month, day, hour, min, sec)
+    x._raw_time = t
+    x.date_time = ( (d>>9)+1980, (d>>5)&0xF, d&0x1F,
+                             t>>11, (t>>5)&0x3F, (t&0x1F) * 2 )
+
+    x._decodeExtra()
+    x.header_offset = x.header_offset + concat
+    x.filename = x._decodeFilename()
+    return x
+
+
+class ZipIndex:
+    """Compact read-only index of the central directory of ZIP archive.
+
+    The directory is read through mmap if archive file has a file
+    descriptor (and into a string otherwise). Only offsets, flag bits
+    and name lengths of directory records are stored, in arrays; names
+    and ZipInfo instances are built on demand, so entries can be filtered by name before any
+    ZipInfo is created.
+
+    Usage:
+        zf = ZipFile(path, lazy=True)
+        for i in zf.index.filter(['*.jpg', '*.png']):
+            info = zf.index.info(i)
+    """
+
+    def __init__(self, fp, start_dir, size_cd, concat):
+        self.concat = concat
+        self._mmap = None
+        if mmap is not None:
+            try:
+                fileno = fp.fileno()
+                self._mmap = mmap.mmap(fileno, 0, access=mmap.ACCESS_READ)
+            except (AttributeError, EnvironmentError, ValueError):
+                # no file descriptor (e.g. in-memory file) or mmap failed
+                pass
+
+        if self._mmap is not None:
+            self.data = self._mmap
+            start = start_dir
+        else:
+            fp.seek(start_dir, 0)
+            self.data = fp.read(size_cd)
+            start = 0
+        end = start + size_cd
+        if end > len(self.data):
+            self.close()
+            raise BadZipfile, "Truncated central directory"
+
+        self.offsets = array.array('L')
+        self.flags = array.array('H')
+        self.name_lengths = array.array('H')
+        data = self.data
+        pos = start
+        unpack_from = struct.unpack_from
+        while pos < end:
+            if data[pos:pos+4] != stringCentralDir:
+                self.close()
+                raise BadZipfile, "Bad magic number for central directory"
+            # flag bits, file name, extra field and comment lengths
+            flags, n, m, k = unpack_from("<8xH18x3H", data, pos)
+            self.offsets.append(pos)
+            self.flags.append(flags)
+            self.name_lengths.append(n)
+            pos = pos + sizeCentralDir + n + m + k
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def name(self, i):
+        """Return the name of i-th entry."""
+        pos = self.offsets[i] + sizeCentralDir
+        name = self.data[pos:pos + self.name_lengths[i]]
+        if self.flags[i] & 0x800:
+            return name.decode('utf-8')
+        return name
+
+    def layout(self, i):
+        """Return (compress_type, compress_size, header_offset) of i-th
+        entry without creating ZipInfo instance."""
+        compress_type, compress_size, header_offset = \
+            struct.unpack_from("<10xH8xL18xL", self.data, self.offsets[i])
+        if compress_size == 0xffffffffL or header_offset == 0xffffffffL:
+            # real values are in ZIP64 extra field
+            info = self.info(i)
+            return info.compress_type, info.compress_size, info.header_offset
+        return compress_type, compress_size, header_offset + self.concat
+
+    def names(self):
+        """Return a list of entry names."""
+        return [self.name(i) for i in xrange(len(self.offsets))]
+
+    def info(self, i):
+        """Return ZipInfo instance for i-th entry."""
+        data = self.data
+        pos = self.offsets[i]
+        centdir = struct.unpack_from(structCentralDir, data, pos)
+        pos = pos + sizeCentralDir
+        filename = data[pos:pos + centdir[_CD_FILENAME_LENGTH]]
+        pos = pos + centdir[_CD_FILENAME_LENGTH]
+        extra = data[pos:pos + centdir[_CD_EXTRA_FIELD_LENGTH]]
+        pos = pos + centdir[_CD_EXTRA_FIELD_LENGTH]
+        comment = data[pos:pos + centdir[_CD_COMMENT_LENGTH]]
+        return _InfoFromCentralDir(centdir, filename, extra, comment, self.concat)
+
+    def infolist(self, indexes=None):
+        """Return a list of ZipInfo instances for given entry indexes
+        (for all entries by default)."""
+        if indexes is None:
+            indexes = xrange(len(self.offsets))
+        return [self.info(i) for i in indexes]
+
+    def filter(self, patterns, ignore_case=True):
+        """Return a list of indexes of entries with names matching
+        any of shell-style patterns (see fnmatch module)."""
+        regex = '|'.join([fnmatch.translate(p) for p in patterns])
+        match = re.compile(regex, ignore_case and re.IGNORECASE or 0).match
+        name = self.name
+        return [i for i in xrange(len(self.offsets)) if match(name(i))]
+
+    def close(self):
+        if self._mmap is not None:
+            self._mmap.close()
+            self._mmap = None
+        self.data = ''
+
+
 class ZipExtFile:
     """File-like object for reading an archive member.
        Is returned by ZipFile.open().
@@ -456,12 +644,22 @@ class ZipExtFile:
         self.compress_type = zipinfo.compress_type
         self.compress_size = zipinfo.compress_size
 
+        # CRC of uncompressed data is checked when the whole file is read
+        self.file_size = zipinfo.file_size
+        self.bytes_out = 0L
+        self.expected_crc = zipinfo.CRC & 0xffffffff
+        self.running_crc = 0
+
         self.closed  = False
         self.mode    = "r"
         self.name = zipinfo.filename
 
         # read from compressed files in 64k blocks
         self.compreadsize = 64*1024
+        # readinto() starts with compreadsize blocks and grows them up
+        # to maxreadsize
+        self.readsize = self.compreadsize
+        self.maxreadsize = 1024*1024
         if self.compress_type == ZIP_DEFLATED:
             self.dc = zlib.decompressobj(-15)
 
@@ -486,6 +684,15 @@ class ZipExtFile:
     def close(self):
         self.closed = True
 
+    def _update_crc(self, data):
+        """Update CRC with uncompressed data and raise BadZipfile
+           if the whole file is read and its CRC is wrong."""
+        self.running_crc = crc32(data, self.running_crc)
+        self.bytes_out += len(data)
+        if self.bytes_out >= self.file_size and \
+           (self.running_crc & 0xffffffff) != self.expected_crc:
+            raise BadZipfile("Bad CRC-32 for file %r" % self.name)
+
     def _checkfornewline(self):
         nl, nllen = -1, -1
         if self.linebuffer:
@@ -558,6 +765,66 @@ class ZipExtFile:
             result.append(line)
         return result
 
+    def readinto(self, b):
+        """Read up to len(b) bytes into bytearray b and return the number
+           of bytes read, 0 at the end of file. Requires python >= 2.6
+           (see HAVE_BYTEARRAY). Decompressed data is written straight to the buffer,
+           and raw blocks grow up to maxreadsize while the buffer asks for
+           more data.
+        """
+        size = len(b)
+        n = 0
+
+        # data left by read()
+        if self.readbuffer:
+            n = min(size, len(self.readbuffer))
+            b[:n] = self.readbuffer[:n]
+            self.readbuffer = self.readbuffer[n:]
+
+        compress_size = self.compress_size
+        if self.decrypter is not None:
+            compress_size -= 12
+
+        while n < size:
+            if not self.rawbuffer:
+                bytesToRead = min(self.readsize, compress_size - self.bytes_read)
+                if bytesToRead <= 0:
+                    break
+                bytes = self.fileobj.read(bytesToRead)
+                if not bytes:
+                    break
+                self.bytes_read += len(bytes)
+                if self.decrypter is not None:
+                    bytes = self.decrypter.decrypt(bytes)
+                self.rawbuffer = bytes
+
+            if self.compress_type == ZIP_DEFLATED:
+                if self.dc is None:
+                    break
+                data = self.dc.decompress(self.rawbuffer, size - n)
+                self.rawbuffer = self.dc.unconsumed_tail
+                if not self.rawbuffer and self.bytes_read >= compress_size:
+                    data += self.dc.flush()
+                    self.dc = None
+            else:
+                data = self.rawbuffer[:size - n]
+                self.rawbuffer = self.rawbuffer[len(data):]
+
+            if not self.rawbuffer and self.readsize < self.maxreadsize:
+                # the whole block was consumed, read bigger one next time
+                self.readsize = min(self.readsize * 2, self.maxreadsize)
+
+            if data:
+                self._update_crc(data)
+            if len(data) > size - n:
+                # flushed data doesn't fit
+                self.readbuffer = data[size - n:]
+                data = data[:size - n]
+            b[n:n + len(data)] = data
+            n += len(data)
+
+        return n
+
     def read(self, size = None):
         # act like file() obj and return empty string if size is 0
         if size == 0:
@@ -602,7 +869,7 @@ class ZipExtFile:
 
                 # decrypt new data if we were given an object to handle that
                 if newdata and self.decrypter is not None:
-                    newdata = ''.join(map(self.decrypter, newdata))
+                    newdata = self.decrypter.decrypt(newdata)
 
                 # decompress newly read data if necessary
                 if newdata and self.compress_type == ZIP_DEFLATED:
@@ -616,6 +883,8 @@ class ZipExtFile:
                         # prevent decompressor from being used again
                         self.dc = None
 
+                if newdata:
+                    self._update_crc(newdata)
                 self.readbuffer += newdata
 
 
@@ -642,12 +911,17 @@ class ZipFile:
     allowZip64: if True ZipFile will create files with ZIP64 extensions when
                 needed, otherwise it will raise an exception when this would
                 be necessary.
+    lazy: if True (read mode only) the central directory is kept in
+          ZipIndex (available as index attribute) and filelist and
+          NameToInfo are built on first access.
 
     """
 
     fp = None                   # Set here since __del__ checks it
+    index = None
 
-    def __init__(self, file, mode="r", compression=ZIP_STORED, allowZip64=False):
+    def __init__(self, file, mode="r", compression=ZIP_STORED, allowZip64=False,
+                 lazy=False):
         """Open the ZIP file with mode read "r", write "w" or append "a"."""
         if mode not in ("r", "w", "a"):
             raise RuntimeError('ZipFile() requires mode "r", "w", or "a"')
@@ -670,6 +944,7 @@ class ZipFile:
         self.mode = key = mode.replace('b', '')[0]
         self.pwd = None
         self.comment = ''
+        self._lazy = lazy and self.mode == 'r'
 
         # Check if we were passed a file-like object
         if isinstance(file, basestring):
@@ -740,6 +1015,11 @@ class ZipFile:
             print "given, inferred, offset", offset_cd, inferred, concat
         # self.start_dir:  Position of start of central directory
         self.start_dir = offset_cd + concat
+        if self._lazy:
+            self.index = ZipIndex(fp, self.start_dir, size_cd, concat)
+            # built from index by __getattr__ when needed
+            del self.filelist, self.NameToInfo
+            return
         fp.seek(self.start_dir, 0)
         data = fp.read(size_cd)
         fp = cStringIO.StringIO(data)
@@ -752,23 +1032,9 @@ class ZipFile:
             if self.debug > 2:
                 print centdir
             filename = fp.read(centdir[_CD_FILENAME_LENGTH])
-            # Create ZipInfo instance to store file information
-            x = ZipInfo(filename)
-            x.extra = fp.read(centdir[_CD_EXTRA_FIELD_LENGTH])
-            x.comment = fp.read(centdir[_CD_COMMENT_LENGTH])
-            x.header_offset = centdir[_CD_LOCAL_HEADER_OFFSET]
-            (x.create_version, x.create_system, x.extract_version, x.reserved,
-                x.flag_bits, x.compress_type, t, d,
-                x.CRC, x.compress_size, x.file_size) = centdir[1:12]
-            x.volume, x.internal_attr, x.external_attr = centdir[15:18]
-            # Convert date/time code to (year, month, day, hour, min, sec)
-            x._raw_time = t
-            x.date_time = ( (d>>9)+1980, (d>>5)&0xF, d&0x1F,
-                                     t>>11, (t>>5)&0x3F, (t&0x1F) * 2 )
-
-            x._decodeExtra()
-            x.header_offset = x.header_offset + concat
-            x.filename = x._decodeFilename()
+            extra = fp.read(centdir[_CD_EXTRA_FIELD_LENGTH])
+            comment = fp.read(centdir[_CD_COMMENT_LENGTH])
+            x = _InfoFromCentralDir(centdir, filename, extra, comment, concat)
             self.filelist.append(x)
             self.NameToInfo[x.filename] = x
 
@@ -781,6 +1047,14 @@ class ZipFile:
                 print "total", total
 
 
+    def __getattr__(self, name):
+        if name in ('filelist', 'NameToInfo') and \
+           self.__dict__.get('index') is not None:
+            self.filelist = self.index.infolist()
+            self.NameToInfo = dict([(x.filename, x) for x in self.filelist])
+            return self.__dict__[name]
+        raise AttributeError(name)
+
     def namelist(self):
         """Return a list of file names in the archive."""
         l = []
@@ -808,8 +1082,13 @@ class ZipFile:
                 # Read by chunks, to avoid an OverflowError or a
                 # MemoryError with very large embedded files.
                 f = self.open(zinfo.filename, "r")
-                while f.read(chunk_size):     # Check CRC-32
-                    pass
+                if HAVE_BYTEARRAY:
+                    buf = bytearray(chunk_size)
+                    while f.readinto(buf):     # Check CRC-32
+                        pass
+                else:
+                    while f.read(chunk_size):     # Check CRC-32
+                        pass
             except BadZipfile:
                 return zinfo.filename
 
@@ -830,6 +1109,45 @@ class ZipFile:
         """Return file bytes (as a string) for name."""
         return self.open(name, "r", pwd).read()
 
+    def copystored(self, zinfo, fileobj, chunksize=1024*1024):
+        """Copy data of stored (not compressed and not encrypted) member
+        straight from the memory-mapped archive to fileobj, checking its
+        CRC on the fly. Return True on success and False if the member
+        can't be copied this way: it is compressed or encrypted, or the
+        archive was not opened with lazy=True from a real file."""
+        if self.index is None or self.index._mmap is None:
+            return False
+        if zinfo.compress_type != ZIP_STORED or zinfo.flag_bits & 0x1:
+            return False
+
+        data = self.index._mmap
+        pos = zinfo.header_offset
+        fheader = data[pos:pos + sizeFileHeader]
+        if fheader[0:4] != stringFileHeader:
+            raise BadZipfile, "Bad magic number for file header"
+        fheader = struct.unpack(structFileHeader, fheader)
+        pos = pos + sizeFileHeader
+        fname = data[pos:pos + fheader[_FH_FILENAME_LENGTH]]
+        if fname != zinfo.orig_filename:
+            raise BadZipfile, \
+                      'File name in directory "%s" and header "%s" differ.' % (
+                          zinfo.orig_filename, fname)
+        pos = pos + fheader[_FH_FILENAME_LENGTH] + fheader[_FH_EXTRA_FIELD_LENGTH]
+        end = pos + zinfo.compress_size
+        if end > len(data):
+            raise BadZipfile, "Truncated data for file %r" % zinfo.filename
+
+        # buffer() slices of mmap are written without copying
+        crc = 0
+        while pos < end:
+            chunk = buffer(data, pos, min(chunksize, end - pos))
+            crc = crc32(chunk, crc)
+            fileobj.write(chunk)
+            pos = pos + len(chunk)
+        if (crc & 0xffffffff) != (zinfo.CRC & 0xffffffff):
+            raise BadZipfile("Bad CRC-32 for file %r" % zinfo.filename)
+        return True
+
     def open(self, name, mode="r", pwd=None):
         """Return file-like object for 'name'."""
         if mode not in ("r", "U", "rU"):
@@ -887,7 +1205,7 @@ class ZipFile:
             #  or the MSB of the file time depending on the header type
             #  and is used to check the correctness of the password.
             bytes = zef_file.read(12)
-            h = map(zd, bytes[0:12])
+            h = zd.decrypt(bytes[0:12])
             if zinfo.flag_bits & 0x8:
                 # compare against the file type from extended local headers
                 check_byte = (zinfo._raw_time >> 8) & 0xff
@@ -1225,6 +1543,8 @@ class ZipFile:
             self.fp.write(self.comment)
             self.fp.flush()
 
+        if self.index is not None:
+            self.index.close()
         if not self._filePassed:
             self.fp.close()
         self.fp = None
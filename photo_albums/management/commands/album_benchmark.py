@@ -0,0 +1,65 @@
+#coding: utf-8
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import simplejson
+
+from photo_albums.benchmark import run_benchmark, create_user_owner, decrypt_benchmark
+
+
+def _import(path):
+    module_name, attr = path.rsplit('.', 1)
+    module = __import__(module_name, {}, {}, [attr])
+    return getattr(module, attr)
+
+
+class Command(BaseCommand):
+    option_list = BaseCommand.option_list + (
+        make_option('--sizes', dest='sizes', default='10,100,1000',
+                    help='Comma-separated album sizes. Default is 10,100,1000.'),
+        make_option('--runs', dest='runs', type='int', default=10,
+                    help='How many times each view is requested. Default is 10.'),
+        make_option('--owner-factory', dest='owner_factory', default=None,
+                    help='Dotted path to function that accepts integer and '
+                         'returns new album owner. Default is to create users.'),
+        make_option('--url-field', dest='url_field', default='pk',
+                    help='Owner attribute used as object_id in urls. Default is pk.'),
+        make_option('--output', dest='output', default=None,
+                    help='File to write json report to. Default is stdout.'),
+        make_option('--decrypt', dest='decrypt', action='store_true', default=False,
+                    help='Only run zip decryption benchmark (no album site is needed).'),
+        make_option('--decrypt-size', dest='decrypt_size', type='int', default=1024*1024,
+                    help='Size of data for zip decryption benchmark. Default is 1M.'),
+    )
+    help = 'Runs load benchmark for PhotoAlbumSite instance views in a test database.'
+    args = '<dotted path to PhotoAlbumSite instance>'
+
+    def handle(self, *args, **options):
+        if options['decrypt']:
+            report = decrypt_benchmark(options['decrypt_size'])
+        else:
+            report = self.album_report(args, options)
+
+        data = simplejson.dumps(report, indent=2)
+        if options['output']:
+            output = open(options['output'], 'w')
+            output.write(data)
+            output.close()
+        else:
+            print data
+
+    def album_report(self, args, options):
+        if len(args) != 1:
+            raise CommandError('Please provide dotted path to PhotoAlbumSite instance.')
+
+        album_site = _import(args[0])
+        owner_factory = create_user_owner
+        if options['owner_factory']:
+            owner_factory = _import(options['owner_factory'])
+        try:
+            sizes = [int(size) for size in options['sizes'].split(',')]
+        except ValueError:
+            raise CommandError('--sizes should be comma-separated integers.')
+
+        return run_benchmark(album_site, sizes, options['runs'], owner_factory,
+                             url_field=options['url_field'])
@@ -1 +1,10 @@
-# empty models file is needed for templatetags to work
+# models file is needed for templatetags to work
+
+from django.db.models.signals import post_save, post_delete
+from generic_images.models import AttachedImage
+
+from photo_albums.album_cache import bump_image_album_version
+
+# album pages are invalidated on any change of images, not only in views
+post_save.connect(bump_image_album_version, sender=AttachedImage)
+post_delete.connect(bump_image_album_version, sender=AttachedImage)
@@ -0,0 +1,34 @@
+#coding: utf-8
+'''
+    Signals sent by photo_albums.
+
+    ``view_finished`` is sent after each :mod:`photo_albums.views` view is
+    processed. Views are not timed at all if there are no receivers.
+    Arguments: ``sender`` (view function), ``view_name``, ``instance_name``
+    (of ``PhotoAlbumSite``), ``request``, ``response``, ``queries`` and
+    ``sql_time`` (number of sql queries and their total time in seconds,
+    None if queries are not logged: query logging is enabled during the
+    view for django >= 1.3 and requires ``DEBUG=True`` for older versions),
+    ``render_time`` (template rendering time in seconds) and ``total_time``
+    (view wall time in seconds). Example::
+
+        from photo_albums.signals import view_finished
+
+        def report(sender, view_name, instance_name, total_time, **kwargs):
+            statsd.timing('albums.%s.%s' % (instance_name, view_name), total_time)
+        view_finished.connect(report)
+
+    ``zip_import_finished`` is sent after successful
+    ``UploadZipForm.process_zip_file`` call. Arguments: ``sender`` (form
+    class), ``form`` and ``stats`` (see
+    :class:`~photo_albums.forms.UploadZipForm`).
+'''
+
+import django.dispatch
+
+view_finished = django.dispatch.Signal(providing_args=['view_name', 'instance_name',
+                                                       'request', 'response',
+                                                       'queries', 'sql_time',
+                                                       'render_time', 'total_time'])
+
+zip_import_finished = django.dispatch.Signal(providing_args=['form', 'stats'])
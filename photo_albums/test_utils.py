@@ -39,16 +39,56 @@
             image_in_album_id = 48
             image2_in_album_id = 66
             image_in_other_album_id = 42    
+            
+            # maximum number of sql queries for views (optional)
+            query_budgets = {'show_album': 3, 'show_image': 3}
+            
+            # run each view 20 times against album with 1000 images and 
+            # report median and 95th percentile of response time (optional)
+            timing_runs = 20
+            timing_album_size = 1000
                 
     If you don't use fixtures you can override setUp method and create necessery 
     objects there. 
     
 '''
 
+import sys
+import time
+
+from django.conf import settings
+from django.db import connection
+from django.db.models import Max
 from django.core.urlresolvers import reverse, NoReverseMatch
 from generic_utils.test_helpers import ViewTest
 from generic_images.models import AttachedImage
 
+
+def timing_stats(samples):
+    ''' Returns dict with 'median' and 'p95' (95th percentile) of samples. '''
+    samples = sorted(samples)
+    def percentile(p):
+        return samples[min(len(samples)-1, int(round(p * (len(samples)-1))))]
+    return {'runs': len(samples), 'median': percentile(0.5), 'p95': percentile(0.95)}
+
+
+def count_queries(func, *args, **kwargs):
+    ''' Calls ``func`` and returns (number of sql queries, total sql time,
+        result) tuple. Queries are logged by forcing ``settings.DEBUG``.
+    '''
+    old_debug = settings.DEBUG
+    settings.DEBUG = True
+    connection.queries = []
+    try:
+        result = func(*args, **kwargs)
+        queries = connection.queries
+    finally:
+        settings.DEBUG = old_debug
+        connection.queries = []
+    sql_time = sum([float(query['time']) for query in queries])
+    return len(queries), sql_time, result
+
+
 class AlbumTest(ViewTest):
         
     username = None
@@ -92,6 +132,24 @@ class AlbumTest(ViewTest):
     
     non_existing_image_id = 0
     
+    query_budgets = {}
+    """ a dict with maximum number of sql queries for views, e.g.
+        ``{'show_album': 3, 'edit_album': 5}``. Budget is checked on each
+        request to the view.
+    """
+    
+    timing_runs = 0
+    " how many times each view is run by ``test_timings`` (0 to skip it) "
+    
+    timing_album_size = None
+    """ album is filled with copies of ``image_in_album_id`` image until 
+        it has this number of images before ``test_timings`` is run 
+    """
+    
+    timing_views = [('show_album', {}), ('edit_album', {}), ('reorder_images', {}),
+                    ('show_image', {'image_id': None}), ('edit_image', {'image_id': None})]
+    " views (with extra url kwargs) timed by ``test_timings`` "
+    
     def __init__(self, *args, **kwargs):
         if (self.album_for_id is not None) and (self.album_for_kwargs is not None):
             raise ValueError('Ambiguity between album_for_id and '
@@ -104,18 +162,73 @@ class AlbumTest(ViewTest):
         
         
     
-    def check(self, view, status, kwargs=None):
+    def url_kwargs(self, kwargs=None):
+        ''' Adds kwargs of album object to url resolver ``kwargs``. '''
         if not kwargs:
             kwargs = {}
+        if self.album_for_id is not None:                
+            if not 'object_id' in kwargs:
+                kwargs['object_id'] = self.album_for_id
+        else:
+            if kwargs != self.non_existing_object_kwargs:
+                kwargs.update(self.album_for_kwargs)
+        return kwargs
+    
+    def check(self, view, status, kwargs=None):
         if view not in self.excluded_views:            
             name = '%s:%s' % (self.album_site.instance_name, view,)
-            if self.album_for_id is not None:                
-                if not 'object_id' in kwargs:
-                    kwargs['object_id'] = self.album_for_id
-            else:
-                if kwargs != self.non_existing_object_kwargs:
-                    kwargs.update(self.album_for_kwargs)
-            return self.check_url(name, status, kwargs=kwargs, current_app=self.album_site.app_name)                
+            kwargs = self.url_kwargs(kwargs)
+            if view not in self.query_budgets:
+                return self.check_url(name, status, kwargs=kwargs, current_app=self.album_site.app_name)
+            
+            count, sql_time, response = count_queries(self.check_url, name, status, 
+                                kwargs=kwargs, current_app=self.album_site.app_name)
+            budget = self.query_budgets[view]
+            self.assertTrue(count <= budget, '%s view made %d sql queries, budget is %d' % 
+                                             (view, count, budget))
+            return response
+                
+    def populate_album(self, size):
+        ''' Adds copies of ``image_in_album_id`` image to its album 
+            until album has ``size`` images. 
+        '''
+        image = AttachedImage.objects.get(id=self.image_in_album_id)
+        album = AttachedImage.objects.filter(content_type=image.content_type, 
+                                             object_id=image.object_id)
+        count = album.count()
+        order = album.aggregate(max_order=Max('order'))['max_order'] or 0
+        for i in range(size - count):
+            image.pk = None
+            image.is_main = False
+            image.order = order + i + 1
+            image.send_signal = False
+            image.save()
+            
+    def test_timings(self):
+        if not self.timing_runs:
+            return
+        if self.timing_album_size:
+            self.populate_album(self.timing_album_size)
+        
+        self.assertTrue(self.client.login(username=self.username, password=self.password))
+        
+        self.timings = {}
+        for view, extra_kwargs in self.timing_views:
+            if view in self.excluded_views:
+                continue
+            kwargs = dict(extra_kwargs)
+            if 'image_id' in kwargs and kwargs['image_id'] is None:
+                kwargs['image_id'] = self.image_in_album_id
+            samples = []
+            for i in range(self.timing_runs):
+                start = time.time()
+                self.check(view, 200, kwargs=dict(kwargs))
+                samples.append(time.time() - start)
+            stats = timing_stats(samples)
+            self.timings[view] = stats
+            sys.stderr.write('\n%s:%s: median %.1f ms, p95 %.1f ms (%d runs, %s images)' % (
+                              self.album_site.instance_name, view, stats['median']*1000, 
+                              stats['p95']*1000, stats['runs'], self.timing_album_size or '-'))
                 
     def test_public_views(self):
         self.check('show_album', 200)
@@ -129,6 +242,17 @@ class AlbumTest(ViewTest):
         self.check('show_image', 404, kwargs={'image_id': self.image_in_other_album_id})
         self.check('show_image', 404, kwargs={'image_id': self.non_existing_image_id})
         
+        self.check('album_api', 200)
+        self.check('image_api', 200, kwargs={'image_id': self.image_in_album_id})
+        self.check('image_api', 404, kwargs={'image_id': self.image_in_other_album_id})
+        self.check('image_api', 404, kwargs={'image_id': self.non_existing_image_id})
+        
+        if 'album_api' not in self.excluded_views:
+            url = reverse('%s:album_api' % self.album_site.instance_name,
+                          kwargs=self.url_kwargs(), current_app=self.album_site.app_name)
+            response = self.client.get(url, {'fields': 'id,no_such_field'})
+            self.assertEqual(response.status_code, 400)
+        
     def test_forbidden_views(self):
         self.check('edit_album', 302)
         self.check('upload_main_image', 302)
@@ -138,6 +262,9 @@ class AlbumTest(ViewTest):
         self.check('set_as_main_image', 302, kwargs={'image_id': self.image_in_album_id})
         self.check('clear_main_image', 302, kwargs={'image_id':  self.image_in_album_id})
         self.check('set_image_order', 302)
+        self.check('upload_zip_chunked', 302)
+        self.check('upload_zip_chunk', 302, kwargs={'upload_id': '0' * 32})
+        self.check('upload_zip_chunked_finalize', 302, kwargs={'upload_id': '0' * 32})
         
     def test_auth_views(self):
         self.assertTrue(self.client.login(username=self.username, password=self.password))
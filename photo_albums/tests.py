@@ -0,0 +1,226 @@
+#coding: utf-8
+'''
+    Unit tests for bundled zipfile library, zip upload forms and chunked
+    uploads. Tests of zipfile library don't need django::
+
+        python -m unittest photo_albums.tests
+'''
+
+import os
+import shutil
+import tempfile
+import unittest
+import zipfile
+from cStringIO import StringIO
+
+from photo_albums.lib import zipfile as lib_zipfile
+
+# contains image.jpg encrypted with u'пароль' password (utf-8 encoded)
+ENCRYPTED_ZIP = os.path.join(os.path.dirname(__file__), 'test_data', 'encrypted.zip')
+ENCRYPTED_PASSWORD = u'пароль'
+
+
+def _make_archive(members, compression):
+    buf = StringIO()
+    zf = zipfile.ZipFile(buf, 'w')
+    for name, data in members:
+        info = zipfile.ZipInfo(name)
+        info.compress_type = compression
+        zf.writestr(info, data)
+    zf.close()
+    return buf.getvalue()
+
+
+class ZipExtFileTest(unittest.TestCase):
+
+    members = [
+        ('empty.txt', ''),
+        ('small.txt', 'hello world'),
+        ('random.bin', os.urandom(200000)),
+        ('repeated.txt', 'abc' * 300000),
+    ]
+
+    def _read_all(self, stream, bufsize):
+        if not lib_zipfile.HAVE_BYTEARRAY:
+            # python < 2.6
+            return stream.read()
+        buf = bytearray(bufsize)
+        result = []
+        while True:
+            n = stream.readinto(buf)
+            if not n:
+                break
+            result.append(str(buf[:n]))
+        return ''.join(result)
+
+    def test_readinto(self):
+        for compression in (zipfile.ZIP_STORED, zipfile.ZIP_DEFLATED):
+            zf = lib_zipfile.ZipFile(StringIO(_make_archive(self.members, compression)))
+            for bufsize in (7, 4096, 65536, 2000000):
+                for name, data in self.members:
+                    got = self._read_all(zf.open(name), bufsize)
+                    self.assertEqual(got, data, '%s, compression %s, buffer %s' %
+                                                (name, compression, bufsize))
+
+    def test_readinto_after_read(self):
+        zf = lib_zipfile.ZipFile(StringIO(_make_archive(self.members, zipfile.ZIP_DEFLATED)))
+        stream = zf.open('repeated.txt')
+        head = stream.read(10)
+        self.assertEqual(head + self._read_all(stream, 65536), 'abc' * 300000)
+
+    def test_bad_crc(self):
+        for compression in (zipfile.ZIP_STORED, zipfile.ZIP_DEFLATED):
+            data = _make_archive([('a.txt', 'a' * 1000)], compression)
+            # change CRC in the central directory
+            pos = data.rindex(lib_zipfile.stringCentralDir) + 16
+            data = data[:pos] + chr(ord(data[pos]) ^ 1) + data[pos+1:]
+
+            zf = lib_zipfile.ZipFile(StringIO(data))
+            self.assertRaises(lib_zipfile.BadZipfile, self._read_all, zf.open('a.txt'), 100)
+            self.assertRaises(lib_zipfile.BadZipfile, zf.open('a.txt').read)
+            self.assertEqual(zf.testzip(), 'a.txt')
+
+    def test_good_crc(self):
+        zf = lib_zipfile.ZipFile(StringIO(_make_archive(self.members, zipfile.ZIP_DEFLATED)))
+        self.assertEqual(zf.testzip(), None)
+
+
+class ZipIndexTest(unittest.TestCase):
+
+    def setUp(self):
+        members = [('dir/%03d.%s' % (i, i % 10 and 'txt' or 'JPG'), 'x' * i)
+                   for i in range(100)]
+        self.data = _make_archive(members, zipfile.ZIP_DEFLATED)
+
+    def test_same_as_eager(self):
+        eager = lib_zipfile.ZipFile(StringIO(self.data))
+        lazy = lib_zipfile.ZipFile(StringIO(self.data), lazy=True)
+        index = lazy.index
+        self.assertEqual(index.names(), eager.namelist())
+        for i, info in enumerate(eager.infolist()):
+            self.assertEqual(index.info(i).header_offset, info.header_offset)
+            self.assertEqual(index.layout(i), (info.compress_type, info.compress_size,
+                                               info.header_offset))
+        # filelist is built on demand
+        self.assertEqual(lazy.namelist(), eager.namelist())
+
+    def test_filter(self):
+        zf = lib_zipfile.ZipFile(StringIO(self.data), lazy=True)
+        index = zf.index
+        self.assertEqual(index.filter(['*.jpg']), range(0, 100, 10))
+        self.assertEqual(index.filter(['*.jpg'], ignore_case=False), [])
+
+
+class ZipDecrypterTest(unittest.TestCase):
+
+    def test_decrypt(self):
+        data = os.urandom(10000)
+        per_char = ''.join(map(lib_zipfile._ZipDecrypter('secret'), data))
+        decrypter = lib_zipfile._ZipDecrypter('secret')
+        self.assertEqual(decrypter.decrypt(data[:100]) + decrypter.decrypt(data[100:]),
+                         per_char)
+
+    def test_encrypted_archive(self):
+        zf = lib_zipfile.ZipFile(ENCRYPTED_ZIP)
+        zf.setpassword(ENCRYPTED_PASSWORD.encode('utf-8'))
+        self.assertEqual(zf.read('image.jpg'), 'secret image data\n' * 200)
+        self.assertEqual(zf.testzip(), None)
+
+        zf.setpassword('wrong')
+        self.assertRaises(RuntimeError, zf.read, 'image.jpg')
+
+
+class UploadZipFormTest(unittest.TestCase):
+    ''' Needs django. '''
+
+    def test_password(self):
+        from django.forms import ValidationError
+        from photo_albums.forms import UploadZipForm
+
+        form = UploadZipForm({'password': ENCRYPTED_PASSWORD})
+        form.check_zip_file(ENCRYPTED_ZIP)
+
+        for data in ({}, {'password': u'wrong'}):
+            form = UploadZipForm(data)
+            self.assertRaises(ValidationError, form.check_zip_file, ENCRYPTED_ZIP)
+
+
+class _UnreadableStream(object):
+    def read(self, size=-1):
+        raise AssertionError('Request body should not be read.')
+
+
+class ChunkedUploadTest(unittest.TestCase):
+    ''' Needs django. '''
+
+    def setUp(self):
+        from photo_albums import uploads
+        self.uploads = uploads
+        self.data = os.urandom(10000)
+        self.dir = tempfile.mkdtemp()
+        self.upload_id = uploads.start_upload('owner', len(self.data), self.dir)
+        self.upload = uploads.get_upload(self.upload_id)
+
+    def tearDown(self):
+        self.uploads.release_upload(self.upload_id)
+        self.uploads.delete_upload(self.upload_id)
+        shutil.rmtree(self.dir)
+
+    def write(self, offset, data, checksum=None, length=None):
+        from django.utils.hashcompat import md5_constructor
+        if checksum is None:
+            checksum = md5_constructor(data).hexdigest()
+        if length is None:
+            length = len(data)
+        return self.uploads.write_chunk(self.upload_id, self.upload, offset,
+                                        StringIO(data), length, checksum)
+
+    def received(self):
+        return self.uploads.received_size(self.upload)
+
+    def test_chunks(self):
+        self.assertEqual(self.write(0, self.data[:4000]), 4000)
+        # chunks may be sent again and may overlap
+        self.assertEqual(self.write(3000, self.data[3000:8000]), 8000)
+        self.assertEqual(self.write(0, self.data[:1000]), 8000)
+        self.assertEqual(self.write(8000, self.data[8000:]), 10000)
+        self.assertEqual(open(self.upload['path'], 'rb').read(), self.data)
+
+    def test_wrong_offset(self):
+        self.write(0, self.data[:1000])
+        UploadError = self.uploads.UploadError
+        self.assertRaises(UploadError, self.write, 2000, self.data[2000:3000])
+        self.assertRaises(UploadError, self.write, -1, self.data[:10])
+        self.assertRaises(UploadError, self.write, 9000, self.data[9000:] + 'x')
+        self.assertEqual(self.received(), 1000)
+
+    def test_too_big_chunk(self):
+        self.assertRaises(self.uploads.UploadError, self.uploads.write_chunk,
+                          self.upload_id, self.upload, 0, _UnreadableStream(),
+                          self.uploads.MAX_CHUNK_SIZE + 1, '')
+
+    def test_checksum_mismatch(self):
+        self.write(0, self.data[:4000])
+        self.assertRaises(self.uploads.UploadError, self.write, 2000,
+                          self.data[2000:5000], checksum='0' * 32)
+        # everything after chunk offset is dropped
+        self.assertEqual(self.received(), 2000)
+        self.assertEqual(self.write(2000, self.data[2000:5000]), 5000)
+        self.assertEqual(open(self.upload['path'], 'rb').read(), self.data[:5000])
+
+    def test_short_body(self):
+        self.write(0, self.data[:1000])
+        self.assertRaises(self.uploads.UploadError, self.write, 1000,
+                          self.data[1000:2000], length=2000)
+        self.assertEqual(self.received(), 1000)
+
+    def test_claim(self):
+        self.assertTrue(self.uploads.claim_upload(self.upload_id))
+        self.assertFalse(self.uploads.claim_upload(self.upload_id))
+        # chunks are not accepted while upload is being finalized
+        self.assertRaises(self.uploads.UploadError, self.write, 0, self.data[:1000])
+        self.assertEqual(self.received(), 0)
+
+        self.uploads.release_upload(self.upload_id)
+        self.assertEqual(self.write(0, self.data[:1000]), 1000)
+        self.assertTrue(self.uploads.claim_upload(self.upload_id))
@@ -0,0 +1,171 @@
+#coding: utf-8
+'''
+    Resumable chunked uploads of zip archives.
+
+    When ``chunked_upload_max_size`` is set for ``PhotoAlbumSite``, big
+    archives can be uploaded in chunks (all responses are json):
+
+    1. ``POST`` to :func:`~photo_albums.views.upload_zip_chunked` view with
+       ``size`` (archive size in bytes) starts the upload and returns
+       ``{"upload_id": "...", "offset": 0}``.
+
+    2. Each chunk (not bigger than ``MAX_CHUNK_SIZE``) is sent as request
+       body with ``PUT`` to :func:`~photo_albums.views.upload_zip_chunk`
+       view with ``offset`` GET parameter and hex md5 digest of the chunk in
+       ``X-Chunk-MD5`` header. The response is
+       ``{"offset": <bytes received>}``. If checksum doesn't match,
+       everything after ``offset`` is dropped. ``GET`` to the same url
+       returns ``{"offset": ..., "size": ...}`` so the upload can be resumed
+       after connection failure, ``DELETE`` aborts it.
+
+    3. ``POST`` to :func:`~photo_albums.views.upload_zip_chunked_finalize`
+       view (with other fields of upload form, e.g. ``password``) validates
+       and imports the assembled archive as
+       :func:`~photo_albums.views.upload_zip` view does. Chunks are not
+       accepted and the upload can't be finalized again while it is
+       being finalized.
+
+    Chunks are written to a file in ``scratch_dir`` of ``PhotoAlbumSite``
+    (system temp dir by default), upload state is stored in django cache.
+    Files of abandoned uploads are left on disk when their state expires,
+    use :func:`remove_stale_uploads` (e.g. from cron) to delete them.
+'''
+
+import os
+import time
+import uuid
+import tempfile
+
+from django.core.cache import cache
+from django.utils.hashcompat import md5_constructor
+
+from photo_albums.forms import _mkstemp
+
+UPLOAD_TIMEOUT = 60*60*24
+''' How long (in seconds) upload state is kept in cache. '''
+
+MAX_CHUNK_SIZE = 16*1024*1024
+''' Maximum size of one chunk in bytes. '''
+
+FILE_PREFIX = 'photo_albums-upload-'
+
+_BLOCK_SIZE = 64*1024
+
+
+class UploadError(Exception):
+    ''' Raised if chunk can't be accepted. '''
+    pass
+
+
+def _cache_key(upload_id):
+    return 'photo_albums.zip_upload.%s' % upload_id
+
+def _claim_key(upload_id):
+    return 'photo_albums.zip_upload_claim.%s' % upload_id
+
+def get_upload(upload_id):
+    ''' Returns upload state dict or None if upload is unknown. '''
+    return cache.get(_cache_key(upload_id))
+
+def received_size(upload):
+    ''' Returns number of bytes received for ``upload``. '''
+    try:
+        return os.path.getsize(upload['path'])
+    except OSError:
+        return 0
+
+
+def start_upload(owner, size, dir=None):
+    '''
+        Creates empty file for upload of ``size`` bytes in ``dir`` and
+        returns upload id. ``owner`` is any picklable value stored with
+        the upload (views use it to check that upload belongs to the album).
+    '''
+    fileno, path = _mkstemp(dir, FILE_PREFIX)
+    os.close(fileno)
+
+    upload_id = uuid.uuid4().hex
+    cache.set(_cache_key(upload_id), {'owner': owner, 'path': path, 'size': size},
+              UPLOAD_TIMEOUT)
+    return upload_id
+
+
+def write_chunk(upload_id, upload, offset, stream, length, checksum):
+    '''
+        Reads ``length`` bytes of chunk from file-like ``stream``, writes
+        them at ``offset`` and returns number of bytes received. Chunk is
+        hashed while it is written; if checksum doesn't match or ``stream``
+        ends early, the file is truncated to ``offset``. Chunks may be sent
+        again, but there should be no gaps between them. Raises
+        ``UploadError`` if chunk is not accepted.
+    '''
+    if cache.get(_claim_key(upload_id)):
+        raise UploadError('Upload is being finalized.')
+    if length > MAX_CHUNK_SIZE:
+        raise UploadError('Chunk is bigger than %d bytes.' % MAX_CHUNK_SIZE)
+    received = received_size(upload)
+    if offset < 0 or offset > received:
+        raise UploadError('Wrong offset, %d bytes are received.' % received)
+    if offset + length > upload['size']:
+        raise UploadError('Chunk is beyond the end of file.')
+
+    upload_file = open(upload['path'], 'r+b')
+    try:
+        upload_file.seek(offset)
+        digest = md5_constructor()
+        left = length
+        while left > 0:
+            block = stream.read(min(left, _BLOCK_SIZE))
+            if not block:
+                break
+            digest.update(block)
+            upload_file.write(block)
+            left -= len(block)
+
+        if left or digest.hexdigest() != checksum.lower():
+            upload_file.truncate(offset)
+            if left:
+                raise UploadError('Chunk is incomplete.')
+            raise UploadError('Chunk checksum mismatch.')
+    finally:
+        upload_file.close()
+    return max(received, offset + length)
+
+
+def claim_upload(upload_id):
+    ''' Marks upload as being finalized. Returns False if it is already
+        claimed (e.g. by concurrent request).
+    '''
+    return cache.add(_claim_key(upload_id), True, UPLOAD_TIMEOUT)
+
+def release_upload(upload_id):
+    ''' Undoes ``claim_upload`` (e.g. if archive is not valid). '''
+    cache.delete(_claim_key(upload_id))
+
+
+def delete_upload(upload_id, remove_file=True):
+    ''' Forgets upload and removes its file unless ``remove_file`` is False. '''
+    upload = get_upload(upload_id)
+    cache.delete(_cache_key(upload_id))
+    if upload is not None and remove_file:
+        try:
+            os.unlink(upload['path'])
+        except OSError:
+            pass
+
+
+def remove_stale_uploads(dir=None, max_age=UPLOAD_TIMEOUT):
+    ''' Removes files of uploads that were not changed for ``max_age``
+        seconds from ``dir`` (system temp dir by default).
+    '''
+    dir = dir or tempfile.gettempdir()
+    if not os.path.isdir(dir):
+        return
+    now = time.time()
+    for name in os.listdir(dir):
+        path = os.path.join(dir, name)
+        try:
+            if name.startswith(FILE_PREFIX) and now - os.path.getmtime(path) > max_age:
+                os.unlink(path)
+        except OSError:
+            pass
@@ -44,6 +44,14 @@
 
         {% url user_images:upload_zip album_user.id %}
 
+        {% url user_images:upload_zip_progress album_user.id job_id %}
+
+        {% url user_images:upload_zip_chunked album_user.id %}
+
+        {% url user_images:upload_zip_chunk album_user.id upload_id %}
+
+        {% url user_images:upload_zip_chunked_finalize album_user.id upload_id %}
+
         {% url user_images:show_image album_user.id image.id %}
 
         {% url user_images:edit_image album_user.id image.id %}
@@ -58,9 +66,19 @@
 
         {% url user_images:set_image_order album_user.id %}
 
+        {% url user_images:album_api album_user.id %}
+
+        {% url user_images:image_api album_user.id image.id %}
+
 '''
 
+import time
+
 from django.conf.urls.defaults import *
+from django.http import Http404
+from django.core.cache import cache
+from django.contrib.contenttypes.models import ContentType
+from django.utils.hashcompat import md5_constructor
 from generic_utils.app_utils import PluggableSite
 from photo_albums.forms import ImageEditForm, PhotoFormSet, UploadZipAlbumForm
 from generic_images.forms import AttachedImageForm
@@ -146,6 +164,76 @@ class PhotoAlbumSite(PluggableSite):
     :class:`~photo_albums.forms.UploadZipAlbumForm`. Form to be used in
     :func:`~photo_albums.views.upload_zip` view.
 
+    .. _page_size:
+
+    ``page_size``: Integer. Optional. If set, images in
+    :func:`~photo_albums.views.show_album` and
+    :func:`~photo_albums.views.edit_album` views are split into pages of
+    ``page_size`` images. Pages are addressed by ``?after=<cursor>`` and
+    ``?before=<cursor>`` GET parameters; ``next_cursor``, ``previous_cursor``,
+    ``has_next`` and ``has_previous`` template variables are provided for
+    building links. Default is None (no pagination). Reorder page is never
+    paginated.
+
+    .. _zip_import_async:
+
+    ``zip_import_async``: Boolean. Optional, default is False. If True,
+    archives uploaded to :func:`~photo_albums.views.upload_zip` view are
+    processed by a background worker (see :mod:`photo_albums.jobs`) and the
+    progress is reported by :func:`~photo_albums.views.upload_zip_progress`
+    view.
+
+    .. _cache_timeout:
+
+    ``cache_timeout``: Integer. Optional. If set, pages rendered by
+    :func:`~photo_albums.views.show_album` and
+    :func:`~photo_albums.views.show_image` views for anonymous users are
+    cached for ``cache_timeout`` seconds. Cache keys include album version
+    (see :mod:`photo_albums.album_cache`) which is changed whenever an
+    image of the album is saved or deleted, in views or elsewhere. Pages
+    may be stale only after images are changed with queryset ``update()``
+    and version is not bumped. Default is None (no caching).
+
+    .. _object_cache_timeout:
+
+    ``object_cache_timeout``: Integer. Optional. If set, the primary key and
+    content type of object resolved from url parameters are stored in
+    django cache for ``object_cache_timeout`` seconds, and the object is
+    then fetched by primary key instead of running ``lookup_field`` or
+    ``object_getter`` lookups (that can follow relations) again. Use
+    :meth:`invalidate_object_cache` when url parameters of object change
+    or when object shouldn't be available anymore. Default is None (no
+    caching).
+
+    .. _permission_cache_timeout:
+
+    ``permission_cache_timeout``: Integer. Optional. Results of
+    ``has_edit_permission`` are always remembered until the end of the
+    request. If ``permission_cache_timeout`` is set they are also stored
+    in user's session for ``permission_cache_timeout`` seconds.
+    Default is None.
+
+    ``has_edit_permission_batch``: Optional. Function that accepts request
+    and a list of objects and returns a list of booleans (like
+    ``has_edit_permission`` for each object). It is used by
+    :meth:`get_permissions` to check permissions for many objects at once.
+
+    .. _scratch_dir:
+
+    ``scratch_dir``: String. Optional. Directory for temporary files of
+    :func:`~photo_albums.views.upload_zip` view (sets ``scratch_dir`` of
+    ``upload_zip_form_class`` form). It should be on the same filesystem
+    as ``MEDIA_ROOT`` so extracted images are renamed instead of copied.
+    Default is None (system temp dir).
+
+    .. _chunked_upload_max_size:
+
+    ``chunked_upload_max_size``: Integer. Optional. If set, zip archives
+    up to this size (in bytes) can be uploaded in chunks and the upload
+    can be resumed after connection failure (see
+    :mod:`photo_albums.uploads` for the protocol). Default is None
+    (chunked uploads are disabled).
+
     '''
     def __init__(self,
                  instance_name,
@@ -161,13 +249,30 @@ class PhotoAlbumSite(PluggableSite):
                  edit_form_class = ImageEditForm,
                  upload_form_class = AttachedImageForm,
                  upload_formset_class = PhotoFormSet,
-                 upload_zip_form_class = UploadZipAlbumForm
+                 upload_zip_form_class = UploadZipAlbumForm,
+                 page_size = None,
+                 zip_import_async = False,
+                 cache_timeout = None,
+                 object_cache_timeout = None,
+                 permission_cache_timeout = None,
+                 has_edit_permission_batch = None,
+                 scratch_dir = None,
+                 chunked_upload_max_size = None
                 ):
 
         self.edit_form_class = edit_form_class
         self.upload_form_class = upload_form_class
         self.upload_formset_class = upload_formset_class
         self.upload_zip_form_class = upload_zip_form_class
+        self.page_size = page_size
+        self.zip_import_async = zip_import_async
+        self.cache_timeout = cache_timeout
+        self.object_cache_timeout = object_cache_timeout
+        self.permission_cache_timeout = permission_cache_timeout
+        self.has_edit_permission_batch = has_edit_permission_batch
+        self.scratch_dir = scratch_dir
+        self.chunked_upload_max_size = chunked_upload_max_size
+        self.queryset = queryset
 
         super(PhotoAlbumSite, self).__init__(instance_name, app_name, queryset,
                                              object_regex, lookup_field,
@@ -175,6 +280,111 @@ class PhotoAlbumSite(PluggableSite):
                                              has_edit_permission, context_processors,
                                              object_getter)
 
+        if object_cache_timeout is not None:
+            self.object_getter = self._cached_object_getter(self.object_getter)
+
+    def _object_cache_key(self, kwargs):
+        params = md5_constructor(repr(sorted(kwargs.items()))).hexdigest()
+        return 'photo_albums.object.%s.%s' % (self.instance_name, params)
+
+    def _cached_object_getter(self, getter):
+        ''' Wraps ``getter`` so it remembers (content type, pk) of found
+            objects in cache. Cached objects are fetched from ``queryset``
+            of the site so they are still filtered by it; only sites with
+            ``object_getter`` fetch them from the default manager.
+        '''
+        def object_getter(**kwargs):
+            key = self._object_cache_key(kwargs)
+            cached = cache.get(key)
+            if cached is not None:
+                content_type_id, pk = cached
+                model = ContentType.objects.get_for_id(content_type_id).model_class()
+                queryset = self.queryset
+                if queryset is None:
+                    queryset = model._default_manager
+                try:
+                    return queryset.get(pk=pk)
+                except model.DoesNotExist:
+                    cache.delete(key)
+
+            obj = getter(**kwargs)
+            content_type = ContentType.objects.get_for_model(obj)
+            cache.set(key, (content_type.pk, obj.pk), self.object_cache_timeout)
+            return obj
+
+        object_getter.regex = getter.regex
+        return object_getter
+
+    def invalidate_object_cache(self, **kwargs):
+        ''' Forget object cached for url parameters ``kwargs``
+            (see ``object_cache_timeout``). Example::
+
+                accounts_photo_site.invalidate_object_cache(object_id='my-slug')
+        '''
+        cache.delete(self._object_cache_key(kwargs))
+
+    def _permission_key(self, request, obj):
+        content_type = ContentType.objects.get_for_model(obj)
+        return '%s.%s.%d.%s' % (self.instance_name, request.user.pk,
+                                content_type.pk, obj.pk)
+
+    def _get_cached_permission(self, request, key):
+        memo = request.__dict__.setdefault('_photo_albums_permissions', {})
+        if key in memo:
+            return memo[key]
+        if self.permission_cache_timeout and hasattr(request, 'session'):
+            allowed, expires = request.session.get('photo_albums_permissions', {}).get(key, (None, 0))
+            if expires > time.time():
+                memo[key] = allowed
+                return allowed
+        return None
+
+    def _set_cached_permission(self, request, key, allowed):
+        request.__dict__.setdefault('_photo_albums_permissions', {})[key] = allowed
+        if self.permission_cache_timeout and hasattr(request, 'session'):
+            now = time.time()
+            permissions = request.session.get('photo_albums_permissions', {})
+            # drop expired results
+            permissions = dict([(k, v) for k, v in permissions.items() if v[1] > now])
+            permissions[key] = (allowed, now + self.permission_cache_timeout)
+            request.session['photo_albums_permissions'] = permissions
+
+    def has_permission(self, request, obj):
+        ''' Returns True if user is allowed to edit album for ``obj``.
+            ``has_edit_permission`` is called once per request for each
+            object (see also ``permission_cache_timeout``).
+        '''
+        key = self._permission_key(request, obj)
+        allowed = self._get_cached_permission(request, key)
+        if allowed is None:
+            allowed = bool(self.has_edit_permission(request, obj))
+            self._set_cached_permission(request, key, allowed)
+        return allowed
+
+    def check_permissions(self, request, object):
+        if not self.has_permission(request, object):
+            raise Http404('Not allowed')
+
+    def get_permissions(self, request, objects):
+        ''' Returns a list of booleans: whether user is allowed to edit album
+            for each object in ``objects``. Results that are not cached are
+            computed with one ``has_edit_permission_batch`` call if it is
+            provided.
+        '''
+        objects = list(objects)
+        keys = [self._permission_key(request, obj) for obj in objects]
+        results = [self._get_cached_permission(request, key) for key in keys]
+        missing = [i for i, allowed in enumerate(results) if allowed is None]
+        if missing and self.has_edit_permission_batch is not None:
+            batch = self.has_edit_permission_batch(request, [objects[i] for i in missing])
+            for i, allowed in zip(missing, batch):
+                results[i] = bool(allowed)
+                self._set_cached_permission(request, keys[i], results[i])
+        else:
+            for i in missing:
+                results[i] = self.has_permission(request, objects[i])
+        return results
+
     def patterns(self):
         return patterns('photo_albums.views',
 
@@ -209,6 +419,30 @@ class PhotoAlbumSite(PluggableSite):
                             {'album_site': self},
                             name = 'upload_zip',
                         ),
+                        url(
+                            self.make_regex(r'/upload-zip/(?P<job_id>[0-9a-f]{32})/'),
+                            'upload_zip_progress',
+                            {'album_site': self},
+                            name = 'upload_zip_progress',
+                        ),
+                        url(
+                            self.make_regex(r'/upload-zip/chunked/'),
+                            'upload_zip_chunked',
+                            {'album_site': self},
+                            name = 'upload_zip_chunked',
+                        ),
+                        url(
+                            self.make_regex(r'/upload-zip/chunked/(?P<upload_id>[0-9a-f]{32})/'),
+                            'upload_zip_chunk',
+                            {'album_site': self},
+                            name = 'upload_zip_chunk',
+                        ),
+                        url(
+                            self.make_regex(r'/upload-zip/chunked/(?P<upload_id>[0-9a-f]{32})/finalize/'),
+                            'upload_zip_chunked_finalize',
+                            {'album_site': self},
+                            name = 'upload_zip_chunked_finalize',
+                        ),
 
 
                         #one image views
@@ -247,7 +481,8 @@ class PhotoAlbumSite(PluggableSite):
                         url(
                             self.make_regex(r'/reorder/'),
                             'edit_album',
-                            {'album_site': self, 'template_name': 'reorder_images.html'},
+                            {'album_site': self, 'template_name': 'reorder_images.html',
+                             'paginate': False},
                             name = 'reorder_images',
                         ),
                         url(
@@ -256,5 +491,19 @@ class PhotoAlbumSite(PluggableSite):
                             {'album_site': self},
                             name = 'set_image_order',
                         ),
+
+                        #json api
+                        url(
+                            self.make_regex(r'/api/'),
+                            'album_api',
+                            {'album_site': self},
+                            name = 'album_api',
+                        ),
+                        url(
+                            self.make_regex(r'/api/(?P<image_id>\d+)/'),
+                            'image_api',
+                            {'album_site': self},
+                            name = 'image_api',
+                        ),
                     )
 
@@ -3,14 +3,27 @@ Views used by PhotoAlbumSite.
 '''
 
 from django.core.urlresolvers import reverse
-from django.http import HttpResponseRedirect, Http404, HttpResponse
-from django.shortcuts import render_to_response, get_object_or_404
-from django.template import RequestContext
+import threading
+import time
+from cStringIO import StringIO
+
+from django.http import HttpResponseRedirect, Http404, HttpResponse, HttpResponseNotModified
+from django.http import HttpResponseBadRequest
+from django.shortcuts import get_object_or_404
+from django.template import RequestContext, Context, loader
+from django.conf import settings
 from django.contrib.auth.decorators import login_required
 from django.contrib.auth.models import User
 from django.views.generic.create_update import delete_object
 from django.utils import simplejson
-from django.core.paginator import Paginator
+from django.db import connection, transaction
+from django.db.models import Q, Count, Max, Sum
+from django.utils.http import parse_etags, quote_etag
+from django.utils.hashcompat import md5_constructor
+from django.utils.functional import wraps
+from django.core.cache import cache
+from django.contrib.contenttypes.models import ContentType
+from django.forms import ValidationError
 
 from annoying.decorators import ajax_request
 from annoying.utils import HttpResponseReload
@@ -19,47 +32,267 @@ from generic_images.models import AttachedImage
 from generic_utils import get_template_search_list
 from generic_utils.app_utils import get_site_decorator
 
+from photo_albums.jobs import start_zip_import, get_job
+from photo_albums.uploads import (start_upload, get_upload, write_chunk, delete_upload,
+                                  received_size, claim_upload, release_upload,
+                                  UploadError, MAX_CHUNK_SIZE)
+from photo_albums.album_cache import get_album_version, bump_album_version, page_cache_key
+from photo_albums.signals import view_finished
+from photo_albums.forms import _ID_BATCH_SIZE
+
 # decorator for AlbumSite views
 album_site_method = get_site_decorator('album_site')
 
+# per-thread counters of instrumented view
+_instrumentation = threading.local()
+
+def _query_log_start():
+    ''' Enables sql query logging if possible and returns the number of
+        already logged queries (or None if queries are not logged).
+    '''
+    if hasattr(connection, 'use_debug_cursor'):
+        _instrumentation.use_debug_cursor = connection.use_debug_cursor
+        connection.use_debug_cursor = True
+    elif not settings.DEBUG:
+        return None
+    return len(connection.queries)
+
+def _query_log_stop(start):
+    if hasattr(connection, 'use_debug_cursor'):
+        connection.use_debug_cursor = _instrumentation.use_debug_cursor
+    if start is None:
+        return None, None
+    queries = list(connection.queries)[start:]
+    return len(queries), sum([float(query['time']) for query in queries])
+
+def instrumented(view_name):
+    ''' Decorator that sends :data:`~photo_albums.signals.view_finished`
+        signal with view timings if it has receivers. It must be the
+        outermost decorator.
+    '''
+    def decorator(view):
+        def wrapper(request, *args, **kwargs):
+            if not view_finished.receivers:
+                return view(request, *args, **kwargs)
+
+            album_site = kwargs.get('album_site')
+            start = time.time()
+            queries_start = _query_log_start()
+            _instrumentation.render_time = 0
+            _instrumentation.active = True
+            try:
+                response = view(request, *args, **kwargs)
+            finally:
+                _instrumentation.active = False
+                queries, sql_time = _query_log_stop(queries_start)
+
+            view_finished.send(sender=view, view_name=view_name,
+                               instance_name=getattr(album_site, 'instance_name', None),
+                               request=request, response=response,
+                               queries=queries, sql_time=sql_time,
+                               render_time=_instrumentation.render_time,
+                               total_time=time.time()-start)
+            return response
+        return wraps(view)(wrapper)
+    return decorator
+
 # a couple of functions to make templates rendering easier
 def _get_template_names(object, template_name):
     return get_template_search_list('albums', object, template_name)
 
+_template_cache = {}
+
+# django < 1.2 keeps state of tags like {% cycle %} in compiled nodes so
+# compiled templates can't be reused
+_template_cache_supported = hasattr(Context(), 'render_context')
+
+def clear_template_cache():
+    ''' Forget all templates resolved by ``_get_template``. '''
+    _template_cache.clear()
+
+def _get_template(obj, template_name):
+    ''' Returns the first existing template from search list for ``obj``.
+        Resolved templates are cached per (model, template name) pair unless
+        ``PHOTO_ALBUMS_TEMPLATE_CACHE`` setting is False. Cache is disabled
+        by default if ``DEBUG`` is True so edited templates are reloaded.
+        Please note that compiled templates are shared between threads.
+        Cache is never used with django < 1.2 because stateful tags
+        (e.g. ``{% cycle %}``) keep their state in compiled templates there.
+    '''
+    if not _template_cache_supported or \
+            not getattr(settings, 'PHOTO_ALBUMS_TEMPLATE_CACHE', not settings.DEBUG):
+        return loader.select_template(_get_template_names(obj, template_name))
+
+    key = (obj.__class__, template_name)
+    try:
+        return _template_cache[key]
+    except KeyError:
+        template = loader.select_template(_get_template_names(obj, template_name))
+        _template_cache[key] = template
+        return template
+
 def _render(template, obj, context):
-    template_variants = _get_template_names(obj, template)
-    return render_to_response(template_variants, context_instance=context)
+    if not getattr(_instrumentation, 'active', False):
+        return HttpResponse(_get_template(obj, template).render(context))
+
+    start = time.time()
+    content = _get_template(obj, template).render(context)
+    _instrumentation.render_time += time.time() - start
+    return HttpResponse(content)
 
 def get_prepared_errors(form):
     return dict([(unicode(f), unicode(form.errors[f][0]),) for f in form.errors]) #todo: get rif of errors[f][0]
 
+def _etag(request, obj, version, image_id=None):
+    ''' Returns ETag for album page. Only one aggregate query is executed.
+        Last-Modified is not sent: album version alone doesn't reflect
+        all changes that are covered by the aggregate.
+    '''
+    stats = AttachedImage.objects.for_model(obj).aggregate(
+                count=Count('id'), max_id=Max('id'), order_sum=Sum('order'))
+    user_id = request.user.is_authenticated() and request.user.pk or None
+    return md5_constructor('%s:%s:%s:%s:%s:%s' % (version, stats['count'],
+                           stats['max_id'], stats['order_sum'], image_id,
+                           user_id)).hexdigest()
+
+def _not_modified(request, etag, image_id=None):
+    if request.method not in ('GET', 'HEAD'):
+        return False
+    if_none_match = request.META.get('HTTP_IF_NONE_MATCH')
+    if not if_none_match:
+        return False
+    etags = parse_etags(if_none_match)
+    # '*' means "page exists"; it is not checked for image pages because
+    # image may not exist
+    return etag in etags or ('*' in etags and image_id is None)
+
+def _cached_page(request, obj, album_site, context, view_name, render, image_id=None):
+    ''' Puts album version to context, answers conditional GET requests
+        with 304 response and serves the page from cache for anonymous
+        users if ``cache_timeout`` is set for ``album_site``.
+        ``render`` is called to render the page if it is needed.
+    '''
+    version = get_album_version(obj)
+    context.update({'album_version': version})
+
+    etag = _etag(request, obj, version, image_id)
+    if _not_modified(request, etag, image_id):
+        response = HttpResponseNotModified()
+    elif album_site.cache_timeout is None or request.user.is_authenticated():
+        response = render()
+    else:
+        key = page_cache_key(request, album_site, view_name, etag)
+        cached = cache.get(key)
+        if cached is not None:
+            content, content_type = cached
+            response = HttpResponse(content, content_type=content_type)
+        else:
+            response = render()
+            if response.status_code == 200:
+                cache.set(key, (response.content, response['Content-Type']),
+                          album_site.cache_timeout)
+
+    if response.status_code in (200, 304):
+        response['ETag'] = quote_etag(etag)
+    return response
+
+
+# keyset pagination for big albums
+
+def _parse_cursor(value):
+    ''' Converts ``'<order>.<id>'`` page cursor to (order, id) tuple. '''
+    try:
+        order, image_id = value.split('.')
+        return int(order), int(image_id)
+    except ValueError:
+        raise Http404('Invalid page cursor.')
+
+def _make_cursor(image):
+    if isinstance(image, dict): # row from values() queryset
+        return '%d.%d' % (image['order'], image['id'])
+    return '%d.%d' % (image.order, image.id)
+
+def _album_page(album, request, page_size):
+    ''' Returns context with one page of images from ``album`` queryset
+        (it can also be a ``values()`` queryset with 'order' and 'id' keys).
+
+        Images are ordered by (-order, -id) and pages are selected by the
+        (order, id) key of the boundary image passed in ``after`` or
+        ``before`` GET parameter, so deep pages are as cheap as the first one.
+        One extra row is fetched instead of running COUNT(*) to find out if
+        there are more pages.
+    '''
+    after = request.GET.get('after')
+    before = request.GET.get('before')
+
+    if before:
+        order, image_id = _parse_cursor(before)
+        rows = album.filter(Q(order__gt=order) | Q(order=order, id__gt=image_id))
+        rows = list(rows.order_by('order', 'id')[:page_size+1])
+        has_previous = len(rows) > page_size
+        images = rows[:page_size]
+        images.reverse()
+        has_next = bool(images)
+    else:
+        if after:
+            order, image_id = _parse_cursor(after)
+            album = album.filter(Q(order__lt=order) | Q(order=order, id__lt=image_id))
+        rows = list(album.order_by('-order', '-id')[:page_size+1])
+        has_next = len(rows) > page_size
+        images = rows[:page_size]
+        has_previous = bool(after and images)
+
+    return {
+        'images': images,
+        'page_size': page_size,
+        'has_next': has_next,
+        'has_previous': has_previous,
+        'next_cursor': _make_cursor(images[-1]) if has_next and images else None,
+        'previous_cursor': _make_cursor(images[0]) if has_previous else None,
+    }
+
+def _album_context(obj, album_site, request, paginate=True):
+    images = AttachedImage.objects.for_model(obj)
+    if paginate and album_site.page_size:
+        return _album_page(images, request, album_site.page_size)
+    return {'images': images}
+
 
 #==============================================================================
 
+@instrumented('show_album')
 @album_site_method(template_name='show_album.html')
 def show_album(request, obj, album_site, context, template_name):
-    ''' Show album for object using show_album.html template '''
+    ''' Show album for object using show_album.html template.
+        Images are paginated if ``page_size`` is set for ``album_site``.
+        Supports conditional GET (ETag header).
+    '''
 
-    images = AttachedImage.objects.for_model(obj)
-    context.update({'images': images})
+    def render():
+        context.update(_album_context(obj, album_site, request))
+        return _render(template_name, obj, context)
 
-    return _render(template_name, obj, context)
+    return _cached_page(request, obj, album_site, context, 'show_album', render)
 
 
 
+@instrumented('edit_album')
 @login_required
-@album_site_method(template_name='edit_album.html')
-def edit_album(request, obj, album_site, context, template_name):
-    ''' Show album for object using edit_album.html template, with permission checks. '''
+@album_site_method(template_name='edit_album.html', paginate=True)
+def edit_album(request, obj, album_site, context, template_name, paginate):
+    ''' Show album for object using edit_album.html template, with permission checks.
+        Images are paginated if ``page_size`` is set for ``album_site`` and
+        ``paginate`` is True.
+    '''
 
     album_site.check_permissions(request, obj)
 
-    images = AttachedImage.objects.for_model(obj)
-    context.update({'images': images})
+    context.update(_album_context(obj, album_site, request, paginate))
 
     return _render(template_name, obj, context)
 
 
+@instrumented('upload_main_image')
 @login_required
 @ajax_request
 @album_site_method()
@@ -92,12 +325,16 @@ def upload_main_image(request, obj, album_site, context):
     return _render('upload_main_image.html', obj, context)
 
 
+@instrumented('upload_zip')
 @login_required
 @ajax_request
 @album_site_method()
 def upload_zip(request, obj, album_site, context):
     ''' Upload zip archive with images, extract them, check if they are correct
         and attach to object. Redirect to ``show_album`` view on success.
+        If ``zip_import_async`` is set for ``album_site`` then archive is
+        processed in background and job id is returned (or user is
+        redirected to ``upload_zip_progress`` view).
     '''
     album_site.check_permissions(request, obj)
 
@@ -105,15 +342,25 @@ def upload_zip(request, obj, album_site, context):
 
     if request.method == 'POST':
         form = form_class(request.user, obj, request.POST, request.FILES)
+        if album_site.scratch_dir is not None:
+            form.scratch_dir = album_site.scratch_dir
         if form.is_valid():
-            form.process_zip_file()
-            success_url = '../' #album_site.reverse('show_album', args=[object_id])
-            if request.is_ajax():
-                return HttpResponse()
-            return HttpResponseRedirect(success_url)
-        else:
-            if request.is_ajax():
-                return get_prepared_errors(form)
+            try:
+                job_id = _import_zip(obj, album_site, form)
+            except ValidationError, e:
+                # corrupt member was found during extraction
+                form._errors['zip_file'] = form.error_class(e.messages)
+            else:
+                if job_id is not None:
+                    if request.is_ajax():
+                        return {'job_id': job_id}
+                    return HttpResponseRedirect('%s/' % job_id)
+                success_url = '../' #album_site.reverse('show_album', args=[object_id])
+                if request.is_ajax():
+                    return HttpResponse()
+                return HttpResponseRedirect(success_url)
+        if request.is_ajax():
+            return get_prepared_errors(form)
     else:
         form = form_class(request.user, obj)
 
@@ -124,6 +371,169 @@ def upload_zip(request, obj, album_site, context):
 
     return _render('upload_zip.html', obj, context)
 
+def _import_zip(obj, album_site, form):
+    ''' Processes valid zip upload form or queues it if ``zip_import_async``
+        is set. Returns job id or None.
+    '''
+    if album_site.zip_import_async:
+        return start_zip_import(form, _job_owner(album_site, obj))
+    form.process_zip_file()
+    return None
+
+def _job_owner(album_site, obj):
+    return [album_site.instance_name, obj.pk]
+
+@instrumented('upload_zip_progress')
+@login_required
+@ajax_request
+@album_site_method(job_id=None)
+def upload_zip_progress(request, obj, album_site, context, job_id):
+    ''' Returns json with state of background zip import job::
+
+        {"state": "running", "file_num": 15, "files_count": 300, "errors": []}
+
+    ``state`` is one of ``'queued'``, ``'running'``, ``'done'`` and
+    ``'failed'``, ``files_count`` is None until archive is opened.
+    '''
+    album_site.check_permissions(request, obj)
+
+    job = get_job(job_id)
+    if job is None or job['owner'] != _job_owner(album_site, obj):
+        raise Http404
+    return dict([(key, value) for key, value in job.items() if key != 'owner'])
+
+def _chunked_upload(album_site, obj, upload_id):
+    if not album_site.chunked_upload_max_size:
+        raise Http404
+    upload = get_upload(upload_id)
+    if upload is None or upload['owner'] != _job_owner(album_site, obj):
+        raise Http404
+    return upload
+
+def _request_stream(request):
+    ''' Returns file-like object for reading request body without loading
+        it to memory (if it is possible).
+    '''
+    if hasattr(request, 'read'):
+        return request
+    if 'wsgi.input' in getattr(request, 'environ', {}):
+        return request.environ['wsgi.input']
+    return StringIO(request.raw_post_data)
+
+@instrumented('upload_zip_chunked')
+@login_required
+@ajax_request
+@album_site_method()
+def upload_zip_chunked(request, obj, album_site, context):
+    ''' Starts chunked upload of zip archive (see :mod:`photo_albums.uploads`).
+    Archive size should be passed as ``size`` POST parameter. Returns json::
+
+        {"upload_id": "3f2a...", "offset": 0}
+    '''
+    album_site.check_permissions(request, obj)
+
+    if not album_site.chunked_upload_max_size:
+        raise Http404
+    if request.method != 'POST':
+        return HttpResponseBadRequest()
+    try:
+        size = int(request.POST['size'])
+    except (KeyError, ValueError):
+        return HttpResponseBadRequest()
+    if size <= 0 or size > album_site.chunked_upload_max_size:
+        return HttpResponseBadRequest()
+
+    upload_id = start_upload(_job_owner(album_site, obj), size, album_site.scratch_dir)
+    return {'upload_id': upload_id, 'offset': 0}
+
+@instrumented('upload_zip_chunk')
+@login_required
+@ajax_request
+@album_site_method(upload_id=None)
+def upload_zip_chunk(request, obj, album_site, context, upload_id):
+    ''' Accepts chunk of zip archive (``PUT`` with ``offset`` GET parameter
+    and ``X-Chunk-MD5`` header), returns upload state (``GET``) or aborts
+    the upload (``DELETE``). Chunk is written to disk as it is read from
+    request, chunks bigger than ``MAX_CHUNK_SIZE`` are rejected before
+    reading. Returns json::
+
+        {"offset": 1048576, "size": 2147483648}
+    '''
+    album_site.check_permissions(request, obj)
+
+    upload = _chunked_upload(album_site, obj, upload_id)
+
+    if request.method == 'PUT':
+        try:
+            offset = int(request.GET['offset'])
+            length = int(request.META['CONTENT_LENGTH'])
+        except (KeyError, ValueError):
+            return HttpResponseBadRequest()
+        if length > MAX_CHUNK_SIZE:
+            return HttpResponseBadRequest('Chunk is bigger than %d bytes.' % MAX_CHUNK_SIZE)
+        try:
+            received = write_chunk(upload_id, upload, offset, _request_stream(request),
+                                   length, request.META.get('HTTP_X_CHUNK_MD5', ''))
+        except UploadError, e:
+            return HttpResponseBadRequest(unicode(e))
+        return {'offset': received, 'size': upload['size']}
+
+    if request.method == 'DELETE':
+        delete_upload(upload_id)
+        return {}
+
+    return {'offset': received_size(upload), 'size': upload['size']}
+
+@instrumented('upload_zip_chunked_finalize')
+@login_required
+@ajax_request
+@album_site_method(upload_id=None)
+def upload_zip_chunked_finalize(request, obj, album_site, context, upload_id):
+    ''' Imports completely uploaded archive as :func:`upload_zip` view does.
+    Other fields of ``upload_zip_form_class`` form (e.g. ``password``) can
+    be passed as POST parameters. Returns form errors or json with job id
+    (None if ``zip_import_async`` is not set)::
+
+        {"job_id": "9b1c..."}
+
+    Upload is kept if form is not valid so it can be finalized again
+    (e.g. with correct password).
+    '''
+    album_site.check_permissions(request, obj)
+
+    upload = _chunked_upload(album_site, obj, upload_id)
+    if request.method != 'POST':
+        return HttpResponseBadRequest()
+    # concurrent requests must not import the same archive twice
+    if not claim_upload(upload_id):
+        return HttpResponseBadRequest('Upload is being finalized.')
+    try:
+        if received_size(upload) != upload['size']:
+            release_upload(upload_id)
+            return HttpResponseBadRequest('Upload is not complete.')
+
+        form = album_site.upload_zip_form_class(request.user, obj, request.POST)
+        if album_site.scratch_dir is not None:
+            form.scratch_dir = album_site.scratch_dir
+        form.set_zip_path(upload['path'])
+        if not form.is_valid():
+            release_upload(upload_id)
+            return get_prepared_errors(form)
+    except:
+        release_upload(upload_id)
+        raise
+
+    # the file is owned by form now; the claim is left to expire so
+    # requests that already got the upload state can't finalize it again
+    delete_upload(upload_id, remove_file=False)
+    try:
+        job_id = _import_zip(obj, album_site, form)
+    except ValidationError, e:
+        form._errors['zip_file'] = form.error_class(e.messages)
+        return get_prepared_errors(form)
+    return {'job_id': job_id}
+
+@instrumented('upload_images')
 @login_required
 @ajax_request
 @album_site_method()
@@ -160,23 +570,50 @@ def upload_images(request, obj, album_site, context):
     return _render('upload_images.html', obj, context)
 
 
+def _neighbour_sql(op, direction):
+    ''' Returns correlated subquery selecting id of image's neighbour in
+        album ordered by (order, id).
+    '''
+    qn = connection.ops.quote_name
+    opts = AttachedImage._meta
+    table = qn(opts.db_table)
+    pk = qn(opts.pk.column)
+    order = qn(opts.get_field('order').column)
+    ct = qn(opts.get_field('content_type').column)
+    object_id = qn(opts.get_field('object_id').column)
+    return ('SELECT n.%(pk)s FROM %(table)s n '
+            'WHERE n.%(ct)s = %(table)s.%(ct)s AND n.%(object_id)s = %(table)s.%(object_id)s '
+            'AND (n.%(order)s %(op)s %(table)s.%(order)s OR '
+            '(n.%(order)s = %(table)s.%(order)s AND n.%(pk)s %(op)s %(table)s.%(pk)s)) '
+            'ORDER BY n.%(order)s %(dir)s, n.%(pk)s %(dir)s LIMIT 1') % {
+                'pk': pk, 'table': table, 'order': order, 'ct': ct,
+                'object_id': object_id, 'op': op, 'dir': direction}
+
 def _one_image_context(image_id, obj):
-    album = AttachedImage.objects.for_model(obj)
+    ''' Fetches image and ids of next and previous images using one query. '''
+    album = AttachedImage.objects.for_model(obj).extra(select={
+        'next_image_id': _neighbour_sql('<', 'DESC'),
+        'prev_image_id': _neighbour_sql('>', 'ASC'),
+    })
     image = get_object_or_404(album, id=image_id)
 
-    next_id = getattr(image.next(), 'id', None)
-    prev_id = getattr(image.previous(), 'id', None)
-
-    return {'image': image, 'prev': prev_id, 'next': next_id}
+    return {'image': image, 'prev': image.prev_image_id, 'next': image.next_image_id}
 
 
+@instrumented('show_image')
 @album_site_method(image_id=None)
 def show_image(request, obj, album_site, context, image_id):
-    '''  Show one image '''
-    context.update(_one_image_context(image_id, obj))
-    return _render('show_image.html', obj, context)
+    '''  Show one image. Supports conditional GET. '''
+
+    def render():
+        context.update(_one_image_context(image_id, obj))
+        return _render('show_image.html', obj, context)
 
+    return _cached_page(request, obj, album_site, context, 'show_image', render,
+                        image_id)
 
+
+@instrumented('edit_image')
 @login_required
 @album_site_method(image_id=None)
 def edit_image(request, obj, album_site, context, image_id):
@@ -200,6 +637,7 @@ def edit_image(request, obj, album_site, context, image_id):
     return _render('edit_image.html', obj, context)
 
 
+@instrumented('delete_image')
 @login_required
 @album_site_method(image_id=None)
 def delete_image(request, obj, album_site, context, image_id):
@@ -224,6 +662,7 @@ def delete_image(request, obj, album_site, context, image_id):
                          template_name = _get_template_names(obj, 'confirm_delete.html')[1])
 
 
+@instrumented('set_as_main_image')
 @login_required
 @album_site_method(image_id=None)
 def set_as_main_image(request, obj, album_site, context, image_id):
@@ -237,6 +676,7 @@ def set_as_main_image(request, obj, album_site, context, image_id):
     return HttpResponseRedirect('../')
 
 
+@instrumented('clear_main_image')
 @login_required
 @album_site_method(image_id=None)
 def clear_main_image(request, obj, album_site, context, image_id):
@@ -251,6 +691,50 @@ def clear_main_image(request, obj, album_site, context, image_id):
     return HttpResponseRedirect('../')
 
 
+@transaction.commit_on_success
+def _set_images_order(obj, orders):
+    ''' Assigns new order values to images attached to ``obj``.
+        ``orders`` is a dict ``{image_id: order}`` with integer keys and
+        values. Ids are checked in batches of ``_ID_BATCH_SIZE`` and all
+        values are written with one UPDATE query (without firing save
+        signals). Returns False and changes nothing if some of the ids
+        don't belong to ``obj``'s album.
+    '''
+    if not orders:
+        return True
+
+    ids = [int(image_id) for image_id in orders]
+    album = AttachedImage.objects.for_model(obj)
+    found = 0
+    for start in range(0, len(ids), _ID_BATCH_SIZE):
+        found += album.filter(id__in=ids[start:start+_ID_BATCH_SIZE]).count()
+    if found != len(ids):
+        return False
+
+    qn = connection.ops.quote_name
+    opts = AttachedImage._meta
+    pk_column = qn(opts.pk.column)
+
+    # ids and orders are integers so they are inlined: the number of
+    # bound parameters doesn't depend on the number of images
+    sql = 'UPDATE %s SET %s = CASE %s %s END WHERE %s IN (%s) AND %s = %%s AND %s = %%s' % (
+        qn(opts.db_table),
+        qn(opts.get_field('order').column),
+        pk_column,
+        ' '.join(['WHEN %d THEN %d' % (image_id, int(orders[image_id])) for image_id in ids]),
+        pk_column,
+        ', '.join(['%d' % image_id for image_id in ids]),
+        qn(opts.get_field('content_type').column),
+        qn(opts.get_field('object_id').column),
+    )
+    params = [ContentType.objects.get_for_model(obj).pk, obj.pk]
+
+    connection.cursor().execute(sql, params)
+    transaction.set_dirty()
+    return True
+
+
+@instrumented('set_image_order')
 @login_required
 @ajax_request
 @album_site_method()
@@ -266,21 +750,138 @@ def set_image_order(request, obj, album_site, context):
         }
 
     and assigns passed order to images with passed id's, with permission checks.
+    The whole payload is rejected if any of the id's is not in the album.
     '''
     album_site.check_permissions(request, obj)
 
     if request.is_ajax():
         data_str = request.POST.get('items','')
-        items = simplejson.loads(data_str)
-        for item in items:
-            image_id = item['id']
-            order = item['order']
-            try:
-                #check that image belongs to proper object
-                image = AttachedImage.objects.for_model(obj).get(id=image_id)
-                image.order = order
-                image.save()
-            except AttachedImage.DoesNotExist:
-                return {'done': False, 'reason': 'Invalid data.'}
+        try:
+            items = simplejson.loads(data_str)
+            orders = dict([(int(item['id']), int(item['order'])) for item in items])
+        except (ValueError, KeyError, TypeError):
+            return {'done': False, 'reason': 'Invalid data.'}
+        if len(orders) != len(items) or not _set_images_order(obj, orders):
+            return {'done': False, 'reason': 'Invalid data.'}
+        # raw UPDATE doesn't send post_save signals
+        bump_album_version(obj)
         return {'done': True}
     raise Http404
+
+
+# JSON API
+
+API_FIELDS = {
+    'id': 'id',
+    'url': 'image',
+    'caption': 'caption',
+    'order': 'order',
+    'is_main': 'is_main',
+    'user_id': 'user',
+}
+''' Fields available in JSON API mapped to AttachedImage fields. '''
+
+API_DEFAULT_FIELDS = ['id', 'url', 'caption']
+
+API_MAX_PAGE_SIZE = 500
+
+def _api_fields(request):
+    ''' Returns list of fields requested by ``fields`` GET parameter or
+        None if there are unknown fields.
+    '''
+    fields = request.GET.get('fields')
+    if not fields:
+        return API_DEFAULT_FIELDS
+    fields = fields.split(',')
+    for field in fields:
+        if field not in API_FIELDS:
+            return None
+    return fields
+
+def _api_columns(fields):
+    return list(set(['id', 'order'] + [API_FIELDS[field] for field in fields]))
+
+def _api_row(row, fields):
+    values = []
+    for field in fields:
+        value = row[API_FIELDS[field]]
+        if field == 'url' and value:
+            value = AttachedImage._meta.get_field('image').storage.url(value)
+        values.append(value)
+    return values
+
+def _json_response(data):
+    return HttpResponse(simplejson.dumps(data, separators=(',', ':')),
+                        mimetype='application/json')
+
+
+@instrumented('album_api')
+@album_site_method()
+def album_api(request, obj, album_site, context):
+    ''' Returns json with one page of album images::
+
+        {"fields":["id","url","caption"],
+         "images":[[12,"/media/images/1/12.jpg","caption"], ...],
+         "has_next":true,"next_cursor":"11.11",
+         "has_previous":false,"previous_cursor":null}
+
+    Fields are selected by ``fields`` GET parameter (comma-separated
+    names from ``API_FIELDS``), pages are selected by ``after`` and ``before``
+    GET parameters as in :func:`show_album` view and page size is set by
+    ``limit`` GET parameter (default is ``page_size`` of ``album_site`` or
+    100, max is ``API_MAX_PAGE_SIZE``). Templates are not rendered and model
+    instances are not created.
+    '''
+    fields = _api_fields(request)
+    try:
+        limit = int(request.GET.get('limit') or album_site.page_size or 100)
+    except ValueError:
+        limit = None
+    if fields is None or not limit or limit < 0:
+        return HttpResponseBadRequest()
+    limit = min(limit, API_MAX_PAGE_SIZE)
+
+    def render():
+        album = AttachedImage.objects.for_model(obj).values(*_api_columns(fields))
+        page = _album_page(album, request, limit)
+        return _json_response({
+            'fields': fields,
+            'images': [_api_row(row, fields) for row in page['images']],
+            'has_next': page['has_next'],
+            'next_cursor': page['next_cursor'],
+            'has_previous': page['has_previous'],
+            'previous_cursor': page['previous_cursor'],
+        })
+
+    return _cached_page(request, obj, album_site, context, 'album_api', render)
+
+
+@instrumented('image_api')
+@album_site_method(image_id=None)
+def image_api(request, obj, album_site, context, image_id):
+    ''' Returns json with one image and ids of next and previous images::
+
+        {"id":12,"url":"/media/images/1/12.jpg","caption":"","next":11,"prev":null}
+
+    Fields are selected by ``fields`` GET parameter as in :func:`album_api`.
+    '''
+    fields = _api_fields(request)
+    if fields is None:
+        return HttpResponseBadRequest()
+
+    def render():
+        album = AttachedImage.objects.for_model(obj).extra(select={
+            'next_image_id': _neighbour_sql('<', 'DESC'),
+            'prev_image_id': _neighbour_sql('>', 'ASC'),
+        })
+        columns = _api_columns(fields) + ['next_image_id', 'prev_image_id']
+        try:
+            row = album.values(*columns).get(id=image_id)
+        except AttachedImage.DoesNotExist:
+            raise Http404
+        data = dict(zip(fields, _api_row(row, fields)))
+        data.update({'next': row['next_image_id'], 'prev': row['prev_image_id']})
+        return _json_response(data)
+
+    return _cached_page(request, obj, album_site, context, 'image_api', render,
+                        image_id)
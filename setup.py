@@ -16,10 +16,12 @@ setup(
 
       description = 'Pluggable Django image gallery app.',
       license = 'MIT license',
-      packages=['photo_albums', 'photo_albums.lib'],
+      packages=['photo_albums', 'photo_albums.lib',
+                'photo_albums.management', 'photo_albums.management.commands'],
       package_data={'photo_albums': ['locale/en/LC_MESSAGES/*',
                                      'locale/ru/LC_MESSAGES/*',
-                                     'locale/pl/LC_MESSAGES/*'
+                                     'locale/pl/LC_MESSAGES/*',
+                                     'test_data/*'
                                      ]},
       include_package_data = True,
 